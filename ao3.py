@@ -5,15 +5,25 @@ import os
 import sys
 import json
 import csv
+import pickle
+import math
+import zlib
+import sqlite3
+import hashlib
+import itertools
 import random
 import multiprocessing
 import datetime
 import argparse
+import heapq
+import queue
+import threading
+import http.server
 import requests
 import collections
 from collections import Counter, defaultdict
 from operator import itemgetter
-from time import sleep
+from time import sleep, monotonic
 
 import numpy
 import pandas as pd
@@ -57,6 +67,39 @@ distance_threshold = 0.1
 number_of_hashes = 15  # Bigger -> slower (linear), more matches
 hash_dimensions = 14   # Bigger -> faster (???), fewer matches
 
+# Set candidate pre-filter parameters:
+# Optionally skip the nearest neighbor search for fan windows that 
+# share few words with the script. This is a lossy heuristic, not a
+# bound: it assumes all word vectors have the same norm and that two
+# different words are never more similar than `max_unshared_similarity`.
+# Neither holds for spacy's vectors, so some windows that would fall
+# under `distance_threshold` can be skipped. Off by default.
+max_unshared_similarity = 1    # Smaller -> faster, more windows pruned, more matches lost; 1 disables pruning
+max_token_postings = 100       # Script words more common than this always count as shared
+
+# Set the seed for the vectors given to words that spacy has no vector for:
+oov_seed = 4815162342
+
+# Set the number of fan windows whose nearest neighbor results are
+# remembered, so repeated phrases are only looked up once. Each search
+# process holds its own cache, at roughly half a kilobyte per window:
+neighbour_cache_size = 20000
+
+# Set the word window sizes at which `format` pre-aggregates
+# sentiment and match counts for the visualization:
+tile_resolutions = [10, 100, 1000]
+
+# Set near-duplicate detection parameters:
+shingle_size = 5              # Words per shingle
+minhash_permutations = 128    # Must be divisible by `minhash_bands`
+minhash_bands = 32            # Bigger -> more candidate pairs checked
+duplicate_threshold = 0.8     # Estimated Jaccard similarity of duplicates
+minhash_seed = 4815162342
+
+# Set the memory budget, in megabytes, for the word vectors of a
+# single fan work; longer works are searched in chunks:
+max_memory = 256
+
 new_record_structure = {
     'fields': ['FAN_WORK_FILENAME', 
                'FAN_WORK_WORD_INDEX', 
@@ -70,9 +113,11 @@ new_record_structure = {
                'BEST_MATCH_DISTANCE',
                'BEST_LEVENSHTEIN_DISTANCE',
                'BEST_COMBINED_DISTANCE',
+               'ORIGINAL_SCRIPT_ID',
               ],
     'types': [str, int, str, int, int, str, 
-              int, str, int, float, int, float
+              int, str, int, float, int, float,
+              str
              ]
 }
 
@@ -181,30 +226,191 @@ def collect_meta(io):
         for row in rows:
             wr.writerow(row)
 
+    if io.get('db'):
+        build_meta_store(rows, io['db'])
+
+def work_id(filename):
+    # Html, text and search output filenames of the same work
+    # share the work id, e.g. `123.html` and `plain-text/123.txt`.
+    return os.path.splitext(os.path.basename(filename))[0]
+
+def parse_meta_date(date):
+    try:
+        return datetime.datetime.strptime(date, '%Y-%m-%d').date().isoformat()
+    except ValueError:
+        return None
+
+def build_meta_store(rows, db_filename):
+    # Works have one row each, with the publication date as an ISO
+    # date; tags get one row per work, category and tag, so that 
+    # the works with a given tag can be found through an index.
+    conn = sqlite3.connect(db_filename)
+    with conn:
+        conn.execute('DROP TABLE IF EXISTS works')
+        conn.execute('DROP TABLE IF EXISTS tags')
+        conn.execute('CREATE TABLE works (WORK_ID TEXT PRIMARY KEY, FILENAME TEXT, '
+                     'TITLE TEXT, AUTHOR TEXT, SUMMARY TEXT, NOTES TEXT, '
+                     'PUBLICATION_DATE DATE, LANGUAGE TEXT)')
+        conn.execute('CREATE TABLE tags (WORK_ID TEXT, CATEGORY TEXT, TAG TEXT)')
+        for row in rows:
+            conn.execute('INSERT OR REPLACE INTO works VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         [work_id(row['FILENAME']), row['FILENAME'], row['TITLE'], 
+                          row['AUTHOR'], row['SUMMARY'], row['NOTES'],
+                          parse_meta_date(row['PUBLICATION_DATE']), row['LANGUAGE']])
+            tags = json.loads(row['TAGS'])
+            conn.executemany('INSERT INTO tags VALUES (?, ?, ?)',
+                             [(work_id(row['FILENAME']), category, tag.strip())
+                              for category, values in tags.items()
+                              for tag in values.split('; ') if tag.strip()])
+
+        conn.execute('CREATE INDEX WORKS_DATE_IX ON works (PUBLICATION_DATE)')
+        conn.execute('CREATE INDEX WORKS_LANGUAGE_IX ON works (LANGUAGE)')
+        conn.execute('CREATE INDEX WORKS_AUTHOR_IX ON works (AUTHOR)')
+        conn.execute('CREATE INDEX TAGS_TAG_IX ON tags (TAG, CATEGORY)')
+        conn.execute('CREATE INDEX TAGS_WORK_IX ON tags (WORK_ID)')
+    conn.close()
+
+meta_filter_fields = {'language': 'LANGUAGE',
+                      'published': 'PUBLICATION_DATE',
+                      'author': 'AUTHOR',
+                      'title': 'TITLE'}
+
+_meta_clause_rex = re.compile(
+    r'\s*(?P<field>tag(?::[^=<>!"]+?)?|\w+)\s*(?P<op>>=|<=|!=|=|>|<)\s*'
+    r'(?:"(?P<quoted>[^"]*)"|(?P<value>.*?))\s*(?:\band\b|$)',
+    re.IGNORECASE
+)
+
+def parse_meta_filter(expression):
+    # A filter is a list of clauses joined by `and`, each of the form
+    # `field op value`, where `field` is one of `meta_filter_fields`, 
+    # `tag` or `tag:Category`, e.g.
+    #     language=English and published>=2016-01-01 and tag:Relationship="A/B"
+    # Values containing " and " must be quoted. Tags only support
+    # `=` and `!=`. Returns an sql condition and its parameters.
+    conditions = []
+    params = []
+    pos = 0
+    while pos < len(expression):
+        m = _meta_clause_rex.match(expression, pos)
+        if not m or m.end() == pos:
+            raise ValueError('Cannot parse filter at: {}'.format(expression[pos:]))
+        pos = m.end()
+
+        field, op = m.group('field'), m.group('op')
+        value = m.group('quoted') if m.group('quoted') is not None else m.group('value')
+        if field.lower().startswith('tag'):
+            if op not in ('=', '!='):
+                raise ValueError('Tags can only be filtered with = or !=')
+            sub = 'SELECT 1 FROM tags WHERE tags.WORK_ID = works.WORK_ID AND TAG = ?'
+            params.append(value)
+            if ':' in field:
+                sub += ' AND CATEGORY = ?'
+                params.append(field.split(':', 1)[1].strip())
+            conditions.append('{}EXISTS ({})'.format('NOT ' if op == '!=' else '', sub))
+        elif field.lower() in meta_filter_fields:
+            conditions.append('{} {} ?'.format(meta_filter_fields[field.lower()], op))
+            params.append(value)
+        else:
+            raise ValueError('Unknown filter field: {}'.format(field))
+
+    if not conditions:
+        raise ValueError('Empty filter')
+    return ' AND '.join(conditions), params
+
+def select_works(db_filename, expression):
+    # The ids of the works in a metadata store that match a filter.
+    if not db_filename:
+        raise ValueError('A metadata filter needs a store built by getmeta --db')
+    condition, params = parse_meta_filter(expression)
+    conn = sqlite3.connect(db_filename)
+    try:
+        rows = conn.execute('SELECT WORK_ID FROM works WHERE ' + condition, params)
+        return set(r[0] for r in rows)
+    finally:
+        conn.close()
+
 # -----------------
 # Utility functions
 # -----------------
 
+class VectorTable(object):
+    # A float32 table of word vectors with one row per spacy orth id
+    # that has a vector, filled in the first time each word is seen.
+    # Documents are then vectorized with a single lookup over their 
+    # unique token ids. Words without a vector are marked rather than
+    # stored, and their sparse rows are built when needed, so the
+    # table grows only up to the size of the model's vocabulary.
+    def __init__(self, vocab, seed, initial_rows=1024):
+        self.vocab = vocab
+        self.seed = seed.to_bytes(8, 'little')
+        self.cols = vocab.vectors_length
+        self.table = numpy.zeros((initial_rows, self.cols), dtype=numpy.float32)
+        self.row_of = {}
+        self.n_rows = 0
+
+    def oov_indices(self, word):
+        # `spacy` doesn't have a pre-trained vector for this word, so
+        # it gets a unique vector with three columns set. Unlike
+        # `hash`, the seeded digest is the same in every process.
+        digest = hashlib.blake2b(word.encode('utf-8'), digest_size=24,
+                                 key=self.seed).digest()
+        return [int.from_bytes(digest[i:i + 8], 'little') % self.cols
+                for i in (0, 8, 16)]
+
+    def add(self, orth_id):
+        # Return the row of `orth_id`, or -1 if it has no vector.
+        lex = self.vocab[orth_id]
+        if not lex.has_vector:
+            self.row_of[orth_id] = -1
+            return -1
+
+        if self.n_rows == len(self.table):
+            table = numpy.zeros((2 * len(self.table), self.cols), dtype=numpy.float32)
+            table[:self.n_rows] = self.table[:self.n_rows]
+            self.table = table
+        self.table[self.n_rows] = lex.vector
+        self.row_of[orth_id] = self.n_rows
+        self.n_rows += 1
+        return self.n_rows - 1
+
+    def vectors(self, orth_ids):
+        if not self.cols:
+            raise ValueError('The spacy model has no word vectors; search needs '
+                             'a model with vectors, e.g. en_core_web_md.')
+        orth_ids = numpy.asarray(orth_ids, dtype=numpy.uint64)
+        unique_ids, inverse = numpy.unique(orth_ids, return_inverse=True)
+        unique_ids = unique_ids.tolist()
+        unique_rows = numpy.array([self.row_of[o] if o in self.row_of else self.add(o)
+                                   for o in unique_ids], dtype=numpy.intp)
+
+        unique_vectors = numpy.zeros((len(unique_ids), self.cols), dtype=numpy.float32)
+        known = unique_rows >= 0
+        unique_vectors[known] = self.table[unique_rows[known]]
+        for i in numpy.flatnonzero(~known):
+            unique_vectors[i, self.oov_indices(self.vocab[unique_ids[i]].orth_)] = 1.0
+        return unique_vectors[inverse.reshape(-1)]
+
+_vector_table = VectorTable(sp.vocab, oov_seed)
+
 def mk_vectors(sp_txt):
     #Given a parsed text in `spacy`'s native format, 
     #produce a sequence of vectors, one per token.
-    
-    rows = len(sp_txt)
-    cols = len(sp_txt[0].vector) if rows else 0
-
-    vectors = numpy.empty((rows, cols), dtype=float)
-    for i, word in enumerate(sp_txt):
-        if word.has_vector:
-            vectors[i] = word.vector
-        else:
-            # `spacy` doesn't have a pre-trained vector for this word
-            # give this word a unique vector
-            w_str = str(word)
-            vectors[i] = 0
-            vectors[i][hash(w_str) % cols] = 1.0
-            vectors[i][hash(w_str * 2) % cols] = 1.0
-            vectors[i][hash(w_str * 3) % cols] = 1.0
-    return vectors
+    orth_ids = numpy.fromiter((word.orth for word in sp_txt),
+                              dtype=numpy.uint64, count=len(sp_txt))
+    return _vector_table.vectors(orth_ids)
+
+def window_view(vectors, window_size):
+    # A zero-copy view of `vectors` in which row `i` is the 
+    # concatenation of rows `i` through `i + window_size - 1`.
+    vectors = numpy.ascontiguousarray(vectors)
+    n_windows = max(vectors.shape[0] - window_size + 1, 0)
+    return numpy.lib.stride_tricks.as_strided(
+        vectors,
+        shape=(n_windows, window_size * vectors.shape[1]),
+        strides=(vectors.strides[0], vectors.strides[1]),
+        writeable=False
+    )
 
 def cosine_distance(row_values, col_values):
     """Calculate the cosine distance between two vectors. Also
@@ -233,16 +439,20 @@ def cosine_distance(row_values, col_values):
     result /= col_norm
     return 1 - result
 
-def build_lsh_engine(orig, window_size, number_of_hashes, hash_dimensions):
+def build_lsh_engine(orig, window_size, number_of_hashes, hash_dimensions,
+                     window_starts=None):
     # Build the ngram vectors using rolling windows. 
     # Variables named `*_win_vectors` contain vectors for
     # the given input, such that each row is the vector
     # for a single window. Successive windows overlap
     # at all words except for the first and last.
 
+    # `window_starts` restricts the index to windows beginning
+    # at the given word indices; by default every window is used.
     orig_vectors = mk_vectors(orig)
-    orig_win_vectors = numpy.array([orig_vectors[i:i + window_size, :].ravel()
-                                   for i in range(orig_vectors.shape[0] - window_size + 1)])
+    orig_win_vectors = window_view(orig_vectors, window_size)
+    if window_starts is None:
+        window_starts = range(orig_win_vectors.shape[0])
 
     # Initialize the approximate nearest neighbor search algorithm.
     # This creates the search "engine" and populates its index with
@@ -269,76 +479,327 @@ def build_lsh_engine(orig, window_size, number_of_hashes, hash_dimensions):
                            lshashes=hashes,
                            distance=nearpy.distances.CosineDistance())
     
-    for ix, row in enumerate(orig_win_vectors):
-        engine.store_vector(row, (ix, str(orig[ix: ix + window_size])))
+    for ix in window_starts:
+        engine.store_vector(orig_win_vectors[ix], 
+                            (ix, str(orig[ix: ix + window_size])))
     return engine
 
-def find_matches_multi(fan_works, ann_index, pool):
-    chunksize = len(fan_works) // (4 * pool._processes)
-    record_sets = pool.map(ann_index.search, fan_works, chunksize=chunksize)
-    records = []
-    records.extend(r for r_set in record_sets for r in r_set)
-    return records
+class NeighbourCache(object):
+    # A least-recently-used map from a fan window's orth ids to its
+    # filtered `(match_ix, distance)` results. `fingerprint` identifies
+    # the scripts and settings the results belong to, so a saved cache
+    # is only reused with the same index.
+    def __init__(self, maxsize=neighbour_cache_size, fingerprint=None):
+        self.maxsize = maxsize
+        self.fingerprint = fingerprint
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Entries added since the last `take_new`, if tracked; pool
+        # workers send these back so they reach the saved cache.
+        self.new_entries = None
+
+    @classmethod
+    def load(cls, filename, maxsize=neighbour_cache_size, fingerprint=None):
+        # Start with an empty cache if there is no saved cache
+        # or it was built for different scripts or settings.
+        # The entries are saved as a plain list, so a cache saved when
+        # this module runs as a script loads when it is imported.
+        if os.path.exists(filename):
+            with open(filename, 'rb') as ip:
+                state = pickle.load(ip)
+            if isinstance(state, dict) and state.get('fingerprint') == fingerprint:
+                cache = cls(maxsize, fingerprint)
+                for key, value in state['entries']:
+                    cache.put(key, value)
+                return cache
+            print('Ignoring neighbour cache {}: it was built for other '
+                  'scripts or settings.'.format(filename))
+        return cls(maxsize, fingerprint)
+
+    def save(self, filename):
+        tmp_filename = filename + '.tmp'
+        state = {'fingerprint': self.fingerprint,
+                 'entries': list(self.entries.items())}
+        with open(tmp_filename, 'wb') as op:
+            pickle.dump(state, op, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
+
+    def get(self, key):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        if self.new_entries is not None:
+            self.new_entries.append((key, value))
+
+    def track_new(self):
+        self.new_entries = []
+
+    def take_new(self):
+        new_entries = self.new_entries or []
+        if self.new_entries is not None:
+            self.new_entries = []
+        return new_entries
 
-def find_matches(fan_works, ann_index, pool):
-    record_sets = map(ann_index.search, fan_works)
-    records = [] #list of map of ann_index.search, fanwords
-    records.extend(r for r_set in record_sets for r in r_set)
-    return records
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+def index_fingerprint(original_script_filenames):
+    # Identifies the scripts and search settings that nearest
+    # neighbor results depend on.
+    digest = hashlib.sha1()
+    for filename in original_script_filenames:
+        with open(filename, 'rb') as ip:
+            digest.update(ip.read())
+    settings = (window_size, distance_threshold, number_of_hashes, hash_dimensions)
+    return digest.hexdigest(), settings
+
+def script_id_from_filename(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+def min_shared_tokens(window_size, distance_threshold, max_unshared_similarity):
+    # If all word vectors had the same norm, and `k` of the window's
+    # words matched exactly and the rest were at most 
+    # `max_unshared_similarity` alike, the window's cosine similarity
+    # would be at most `(k + (window_size - k) * c) / window_size`.
+    # Return the smallest `k` for which that can exceed
+    # `1 - distance_threshold`; see the note on the setting above.
+    c = max_unshared_similarity
+    if c >= 1:
+        return 0
+    k = window_size * (1 - distance_threshold - c) / (1 - c)
+    return max(0, math.ceil(k))
 
 class AnnIndexSearch(object):
-    def __init__(self, original_script_filename, window_size,
-                 number_of_hashes, hash_dimensions, distance_threshold):
-        orig_csv = load_markup_script(original_script_filename)
-        orig_csv = orig_csv[1:]  # drop header
-        orig_csv = [[i] + r for i, r in enumerate(orig_csv)]
+    def __init__(self, original_script_filenames, window_size,
+                 number_of_hashes, hash_dimensions, distance_threshold,
+                 max_memory=max_memory, neighbour_cache=None):
+        if isinstance(original_script_filenames, str):
+            original_script_filenames = [original_script_filenames]
+
+        # The cache may be shared by several indexes over the same scripts.
+        if neighbour_cache is None:
+            neighbour_cache = NeighbourCache()
+        self.neighbour_cache = neighbour_cache
+
+        script_ids = [script_id_from_filename(f) 
+                      for f in original_script_filenames]
+        if len(set(script_ids)) != len(script_ids):
+            raise ValueError('Script filenames must be unique: {}'.format(
+                original_script_filenames))
+
+        # All scripts share one index. Words are numbered within
+        # their own script, and no window spans two scripts.
+        orig_csv = []
+        window_starts = []
+        for script_id, filename in zip(script_ids, original_script_filenames):
+            script_csv = load_markup_script(filename)
+            script_csv = script_csv[1:]  # drop header
+            offset = len(orig_csv)
+            window_starts.extend(range(offset, 
+                                       offset + len(script_csv) - window_size + 1))
+            orig_csv.extend([i] + r + [script_id] 
+                            for i, r in enumerate(script_csv))
         # [['ORIGINAL_SCRIPT_INDEX', 
         #   'LOWERCASE', 
         #   'SPACY_ORTH_ID', 
         #   'SCENE',
-        #   'CHARACTER']]
+        #   'CHARACTER',
+        #   'ORIGINAL_SCRIPT_ID']]
 
         (self.word_index,
          self.word_lowercase, 
          self.orth_id, 
          self.scene, 
-         self.character) = zip(*orig_csv)
+         self.character,
+         self.script_id) = zip(*orig_csv)
+        self.n_scripts = len(script_ids)
 
         self.window_size = window_size
         self.distance_threshold = distance_threshold
+
+        # Number of fan windows whose word vectors fit in `max_memory`.
+        token_bytes = max(_vector_table.cols, 1) * _vector_table.table.itemsize
+        self.chunk_size = max(1, max_memory * 2 ** 20 // token_bytes - window_size + 1)
+
+        self.min_shared_tokens = min_shared_tokens(window_size, 
+                                                   distance_threshold,
+                                                   max_unshared_similarity)
+
+        # Index the script's lowercase n-grams for exact matching, and,
+        # if pruning is turned on, its words by position for the 
+        # candidate pre-filter.
+        self.script_ngrams = defaultdict(list)
+        for start in window_starts:
+            ngram = self.orth_id[start:start + window_size]
+            self.script_ngrams[ngram].append(start)
+        self.script_ngrams = dict(self.script_ngrams)
+
+        self.token_positions = None
+        if self.min_shared_tokens:
+            self.token_positions = defaultdict(list)
+            for ix, orth_id in enumerate(self.orth_id):
+                self.token_positions[orth_id].append(ix)
+            self.token_positions = dict(self.token_positions)
+
         orig_doc = spacy.tokens.Doc(sp.vocab, self.word_lowercase)
         self.engine = build_lsh_engine(orig_doc, window_size, 
-                                       number_of_hashes, hash_dimensions)
+                                       number_of_hashes, hash_dimensions,
+                                       window_starts)
         self.reset_stats()
 
     def reset_stats(self):
         self._windows_processed = 0
+        self._windows_pruned = 0
+        self._exact_matches = 0
         
     @property
     def windows_processed(self):
         return self._windows_processed
+
+    @property
+    def windows_pruned(self):
+        return self._windows_pruned
+
+    @property
+    def exact_matches(self):
+        return self._exact_matches
+
+    def window_string(self, match_ix):
+        # The script text of the window starting at `match_ix`, 
+        # as stored in the engine's index.
+        return ' '.join(self.word_lowercase[match_ix:match_ix + self.window_size])
+
+    def aligned_shared_tokens(self, ngram):
+        # An upper bound on the number of words `ngram` shares with
+        # any single script window, position by position. Words with
+        # very long posting lists are counted as shared everywhere
+        # rather than looked up.
+        votes = Counter()
+        common = 0
+        for window_ix, orth_id in enumerate(ngram):
+            positions = self.token_positions.get(orth_id, ())
+            if len(positions) > max_token_postings:
+                common += 1
+            else:
+                votes.update(ix - window_ix for ix in positions)
+        return common + max(votes.values(), default=0)
+
+    def prefilter(self, fan):
+        # Classify each fan window before the nearest neighbor search.
+        # The result holds, per window, the list of script windows it
+        # matches exactly, `True` if it must be searched, or `False`
+        # if it shares too few words with the script to match. Exact
+        # matches use the case-sensitive orth ids, since those are the
+        # words the fan vectors are made from; the script's words are
+        # lowercase, so capitalized windows are searched as usual.
+        orth = [t.orth for t in fan]
+        n_windows = len(orth) - self.window_size + 1
+        candidates = [self.script_ngrams.get(tuple(orth[i:i + self.window_size]), True)
+                      for i in range(n_windows)]
+        if not self.min_shared_tokens:
+            return candidates
+
+        lower = [t.lower for t in fan]
+        shared = [0] + list(itertools.accumulate(
+            1 if orth_id in self.token_positions else 0 for orth_id in lower
+        ))
+        for fan_ix in range(n_windows):
+            if candidates[fan_ix] is not True:
+                continue
+            ngram = tuple(lower[fan_ix:fan_ix + self.window_size])
+            window_shared = shared[fan_ix + self.window_size] - shared[fan_ix]
+            if (window_shared < self.min_shared_tokens or
+                    self.aligned_shared_tokens(ngram) < self.min_shared_tokens):
+                candidates[fan_ix] = False
+        return candidates
+
+    def neighbour_matches(self, key, row):
+        # `(match_ix, distance)` for the script windows near `row`.
+        # The results depend only on the window's words, so 
+        # repeated phrases are looked up once.
+        matches = self.neighbour_cache.get(key)
+        if matches is None:
+            results = self.engine.neighbours(row)
+
+            # Extract data about the original script
+            # embedded in the engine's results.
+            matches = [(match_ix, distance) 
+                       for vec, (match_ix, match_str), distance in results 
+                       if distance < self.distance_threshold]
+
+            # Most windows match nothing; only windows with matches
+            # are cached, so the cache holds the phrases that count.
+            if matches:
+                self.neighbour_cache.put(key, matches)
+        return matches
+
+    def window_vectors(self, fan):
+        # Yield `(fan_ix, vector)` for each fan window. The text is
+        # vectorized `chunk_size` windows at a time, so memory use
+        # doesn't grow with the length of the work.
+        n_windows = len(fan) - self.window_size + 1
+        for chunk_start in range(0, n_windows, self.chunk_size):
+            chunk_end = min(chunk_start + self.chunk_size, n_windows)
+            fan_vectors = mk_vectors(fan[chunk_start:chunk_end + self.window_size - 1])
+            fan_win_vectors = window_view(fan_vectors, self.window_size)
+            for i, row in enumerate(fan_win_vectors):
+                yield chunk_start + i, row
     
     def search(self, filename):
         with open(filename, encoding='utf8') as fan_file:
             fan = sp(fan_file.read())
+        return self.search_doc(fan, filename)
+
+    def search_doc(self, fan, filename):
+        # Search a fan work already parsed by `spacy`; `filename`
+        # is only used to label the records.
     
         # Create the fan windows:
-        fan_vectors = mk_vectors(fan)
-        fan_win_vectors = numpy.array(
-            [fan_vectors[i:i + self.window_size, :].ravel()
-             for i in range(fan_vectors.shape[0] - self.window_size + 1)]
-        )
+        candidates = self.prefilter(fan)
+        fan_windows = self.window_vectors(fan)
+        fan_orth_ids = [t.orth for t in fan]
 
         duplicate_records = defaultdict(list)
-        for fan_ix, row in enumerate(fan_win_vectors):
+        for (fan_ix, row), candidate in zip(fan_windows, candidates):
             self._windows_processed += 1
-            results = self.engine.neighbours(row)
-            
-            # Extract data about the original script
-            # embedded in the engine's results.
-            results = [(match_ix, match_str, distance) 
-                       for vec, (match_ix, match_str), distance in results 
-                       if distance < self.distance_threshold]
+            if candidate is False:
+                self._windows_pruned += 1
+                continue
+            key = tuple(fan_orth_ids[fan_ix:fan_ix + self.window_size])
+            if candidate is True:
+                results = [(match_ix, self.window_string(match_ix), distance)
+                           for match_ix, distance in self.neighbour_matches(key, row)]
+            else:
+                # Exact matches are taken straight from the n-gram
+                # index; the fan window has the script's exact words,
+                # so their vectors are identical.
+                self._exact_matches += 1
+                results = [(match_ix, self.window_string(match_ix), 0.0)
+                           for match_ix in candidate]
+
+                # Scripts without an exact match are searched as
+                # usual, so each script gets the matches a search
+                # against it alone would find.
+                exact_scripts = set(self.script_id[ix] for ix in candidate)
+                if len(exact_scripts) < self.n_scripts:
+                    results.extend(
+                        (match_ix, self.window_string(match_ix), distance)
+                        for match_ix, distance in self.neighbour_matches(key, row)
+                        if self.script_id[match_ix] not in exact_scripts)
 
             # Create a new record with original script 
             # information and fan work information.
@@ -351,13 +812,15 @@ class AnnIndexSearch(object):
                     fan_word = fan[fan_word_ix].orth_
                     fan_orth_id = fan[fan_word_ix].orth
                     
-                    orig_word_ix = match_ix + window_ix
-                    orig_word = self.word_lowercase[orig_word_ix]
-                    orig_orth_id = self.orth_id[orig_word_ix]
-                    char = self.character[orig_word_ix]
-                    scene = self.scene[orig_word_ix]
+                    orig_ix = match_ix + window_ix
+                    orig_word_ix = self.word_index[orig_ix]
+                    orig_word = self.word_lowercase[orig_ix]
+                    orig_orth_id = self.orth_id[orig_ix]
+                    char = self.character[orig_ix]
+                    scene = self.scene[orig_ix]
+                    script_id = self.script_id[orig_ix]
         
-                    duplicate_records[(filename, fan_word_ix)].append(
+                    duplicate_records[(filename, fan_word_ix, script_id)].append(
                         # NOTE: This **must** match the definition 
                         #       of `record_structure` above
                         [filename,
@@ -371,29 +834,94 @@ class AnnIndexSearch(object):
                          scene,
                          distance, 
                          lev_d, 
-                         distance * lev_d]
+                         distance * lev_d,
+                         script_id]
                     )
                 
         # To deduplicate duplicate_records, we
         # pick the single best match, as measured by 
         # the combined distance for the given n-gram 
-        # match that first identified the word.
+        # match that first identified the word. Each
+        # script keeps its own best match, so a word
+        # quoted in several scripts counts for each.
         for k, dset in duplicate_records.items():
             duplicate_records[k] = min(dset, key=itemgetter(11))
 
         return sorted(duplicate_records.values())
 
+def match_strata_edges(num_strata, max_threshold):
+    return numpy.array([i / num_strata * max_threshold 
+                        for i in range(0, num_strata + 1)])
+
 def make_match_strata(records, record_structure, num_strata, max_threshold):
     combined_ix = record_structure['fields'].index('BEST_COMBINED_DISTANCE')
-    low = [i / num_strata * max_threshold 
-           for i in range(0, num_strata)]
-    high = [i / num_strata * max_threshold 
-            for i in range(1, num_strata + 1)]
-    ranges = zip(low, high)
-    
-    return [[r for r in records[1:] 
-             if r[combined_ix] >= low and r[combined_ix] < high]
-            for low, high in ranges]
+    edges = match_strata_edges(num_strata, max_threshold)
+    distances = numpy.array([r[combined_ix] for r in records[1:]], dtype=float)
+    strata_ix = numpy.searchsorted(edges, distances, side='right') - 1
+
+    strata = [[] for i in range(num_strata)]
+    for r, s in zip(records[1:], strata_ix):
+        if 0 <= s < num_strata:
+            strata[s].append(r)
+    return strata
+
+def count_match_strata(distances, word_indices, num_strata, max_threshold):
+    # Bin matches by script word index and by distance stratum in a
+    # single pass. Entry `[n, s]` of the result is the number of
+    # matches of script word `n` in stratum `s`.
+    edges = match_strata_edges(num_strata, max_threshold)
+    distances = numpy.asarray(distances, dtype=float)
+    word_indices = numpy.asarray(word_indices, dtype=numpy.intp)
+
+    strata_ix = numpy.searchsorted(edges, distances, side='right') - 1
+    keep = (strata_ix >= 0) & (strata_ix < num_strata)
+    strata_ix = strata_ix[keep]
+    word_indices = word_indices[keep]
+
+    n_words = word_indices.max() + 1 if len(word_indices) else 0
+    counts = numpy.bincount(word_indices * num_strata + strata_ix,
+                            minlength=n_words * num_strata)
+    return counts.reshape(n_words, num_strata)
+
+def add_match_strata(counts, more_counts):
+    # Sum two results of `count_match_strata`, which may cover
+    # different numbers of script words.
+    if len(more_counts) > len(counts):
+        counts, more_counts = more_counts, counts
+    counts = counts.copy()
+    counts[:len(more_counts)] += more_counts
+    return counts
+
+def read_match_strata(filename, num_strata, max_threshold, 
+                      script_id=None, chunksize=1000000):
+    # Like `count_match_strata`, but streams the records from a
+    # search output csv instead of holding them in memory.
+    header = pd.read_csv(filename, nrows=0).columns
+    usecols = ['BEST_COMBINED_DISTANCE', 'ORIGINAL_SCRIPT_WORD_INDEX']
+    if 'ORIGINAL_SCRIPT_ID' in header:
+        usecols.append('ORIGINAL_SCRIPT_ID')
+
+    counts = numpy.zeros((0, num_strata), dtype=numpy.int64)
+    script_ids = set()
+    for chunk in pd.read_csv(filename, usecols=usecols, chunksize=chunksize,
+                             dtype={'ORIGINAL_SCRIPT_ID': str}):
+        if script_id is not None:
+            chunk = chunk[chunk['ORIGINAL_SCRIPT_ID'] == script_id]
+        elif 'ORIGINAL_SCRIPT_ID' in chunk:
+            script_ids.update(chunk['ORIGINAL_SCRIPT_ID'].unique())
+            check_single_script(script_ids, filename)
+        chunk_counts = count_match_strata(chunk['BEST_COMBINED_DISTANCE'].values,
+                                          chunk['ORIGINAL_SCRIPT_WORD_INDEX'].values,
+                                          num_strata, max_threshold)
+        counts = add_match_strata(counts, chunk_counts)
+    return counts
+
+def check_single_script(script_ids, source):
+    # Script word indices are only comparable within a single
+    # script, so counts over several scripts would be meaningless.
+    if len(script_ids) > 1:
+        raise ValueError('{} contains matches for several scripts; '
+                         'choose one of {}'.format(source, sorted(script_ids)))
 
 def label_match_strata(num_strata, max_threshold):
     high = [i / num_strata * max_threshold 
@@ -406,33 +934,52 @@ def chart_match_strata(records,
                        start=1, end=None, 
                        figsize=(15, 10), 
                        colormap='plasma',
-                       legend=True):
-    match_strata = make_match_strata(records, new_record_structure, num_strata, max_threshold)
-
-    cumulative_strata = [match_strata[0:i] for i in 
-                         range(len(match_strata), 0, -1)]
-    match_counters = [Counter(row[4] for matches in strata for row in matches) 
-                      for strata in cumulative_strata]
-    maxn = max(max(mc) for mc in match_counters if mc)
-    match_cols = [[mc[n] for mc in match_counters]
-                  for n in range(maxn + 1)]
+                       legend=True,
+                       script_id=None):
+    # `records` is either a list of records headed by the field
+    # names, or the filename of a search output csv. 
+    if isinstance(records, str):
+        counts = read_match_strata(records, num_strata, max_threshold, script_id)
+    else:
+        fields = new_record_structure['fields']
+        combined_ix = fields.index('BEST_COMBINED_DISTANCE')
+        word_ix = fields.index('ORIGINAL_SCRIPT_WORD_INDEX')
+        script_ix = fields.index('ORIGINAL_SCRIPT_ID')
+        if script_id is None:
+            check_single_script(set(r[script_ix] for r in records[1:]), 'records')
+        rows = [r for r in records[1:] 
+                if script_id is None or r[script_ix] == script_id]
+        counts = count_match_strata([r[combined_ix] for r in rows],
+                                    [int(r[word_ix]) for r in rows],
+                                    num_strata, max_threshold)
+
+    # Column `i` counts the matches below the `i`-th highest threshold.
+    match_cols = counts.cumsum(axis=1)[:, ::-1]
 
     col_names = label_match_strata(num_strata, max_threshold)
     col_names.reverse()
     df = pd.DataFrame(match_cols,
-                          index = range(maxn + 1),
+                          index = range(len(match_cols)),
                           columns=col_names)
     df.index.name = 'Word index in original script'
     df = df.loc[start:end]
     df.plot(figsize=figsize, colormap=colormap, legend=legend)
 
 def most_frequent_matches(records, n_matches, threshold):
-    ct = Counter(r[3] for r in records if r[-1] < threshold)
-    ix_to_context = {r[3]: r[4] for r in records}
+    fields = new_record_structure['fields']
+    word_ix = fields.index('ORIGINAL_SCRIPT_WORD_INDEX')
+    word = fields.index('ORIGINAL_SCRIPT_WORD')
+    combined_ix = fields.index('BEST_COMBINED_DISTANCE')
+    script_ix = fields.index('ORIGINAL_SCRIPT_ID')
+
+    # Word indices are numbered within each script, so words are
+    # keyed by script id as well.
+    ct = Counter((r[script_ix], r[word_ix]) for r in records[1:] 
+                 if float(r[combined_ix]) < threshold)
+    ix_to_context = {(r[script_ix], r[word_ix]): r[word] for r in records[1:]}
     matches = ct.most_common(n_matches)
-    return [(i, c, ix_to_context[i]) 
-            for i, c in matches]
-    return matches
+    return [(i, c, ix_to_context[(script_id, i)], script_id) 
+            for (script_id, i), c in matches]
 
 def load_markup_script(filename,
                         _line_rex=re.compile('LINE<<(?P<line>[^>]*)>>'),
@@ -461,47 +1008,333 @@ def write_records(records, filename):
     with open(filename, 'w', encoding='utf-8') as out:
         wr = csv.writer(out)
         wr.writerows(records)
-        
+
+def read_records(filename):
+    # Read a batch file written by `write_records`, without its header.
+    with open(filename, encoding='utf-8') as ip:
+        return list(csv.reader(ip))[1:]
+
+def dated_filename(filename_base):
+    # Fill `filename_base` with today's date, adding a counter
+    # if a file with that name already exists.
+    i = 0
+    today_str = '-{:%Y%m%d}.csv'.format(datetime.date.today())
+    name_check = filename_base.format(today_str)
+    while os.path.exists(name_check):
+        i += 1
+        today_str = '-{:%Y%m%d}-{}.csv'.format(datetime.date.today(), i)
+        name_check = filename_base.format(today_str)
+    return name_check
+
+def parse_shard(shard):
+    # Parse a `--shard` option of the form `i/N`, where `i` is
+    # the zero-based shard index and `N` is the number of shards.
+    try:
+        shard_index, num_shards = (int(s) for s in shard.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'shard must have the form i/N, e.g. 0/4')
+    if num_shards < 1 or not 0 <= shard_index < num_shards:
+        raise argparse.ArgumentTypeError(
+            'shard index must satisfy 0 <= i < N')
+    return shard_index, num_shards
+
+def shard_fan_works(fan_works, shard_index, num_shards):
+    # Deal the works out largest-first, always to the shard with
+    # the fewest bytes so far. Ties are broken by filename, so every
+    # node that lists the same directory computes the same shards.
+    sizes = {f: os.path.getsize(f) for f in fan_works}
+    loads = [(0, i) for i in range(num_shards)]
+    shards = [[] for i in range(num_shards)]
+    for f in sorted(fan_works, key=lambda f: (-sizes[f], f)):
+        load, i = heapq.heappop(loads)
+        shards[i].append(f)
+        heapq.heappush(loads, (load + sizes[f], i))
+    return sorted(shards[shard_index])
+
+def schedule_fan_works(fan_works):
+    # Longest works first, so the last works to be handed out are
+    # short ones and no worker is left with a long work at the end.
+    return sorted(fan_works, key=lambda f: (-os.path.getsize(f), f))
+
+def search_stats(ann_index):
+    return Counter({'windows': ann_index.windows_processed,
+                    'pruned': ann_index.windows_pruned,
+                    'exact': ann_index.exact_matches,
+                    'cache_hits': ann_index.neighbour_cache.hits,
+                    'cache_misses': ann_index.neighbour_cache.misses})
+
+def scheduled_search(fan_works, original_script_markups, workers,
+                     max_memory, neighbour_cache, share_cache=False):
+    # Yield `(filename, records, stats)` for each work as it finishes.
+    # Works are handed to the pool one at a time, so a worker that
+    # finishes early takes the next work instead of sitting idle. 
+    # With one worker the search runs in this process. Pool workers
+    # each start from a copy of `neighbour_cache`; if `share_cache` 
+    # is set, they send back the entries they add, which are merged
+    # into `neighbour_cache` so that they are saved with it.
+    if workers == 1:
+        ann_index = AnnIndexSearch(original_script_markups, 
+                                   window_size, 
+                                   number_of_hashes, 
+                                   hash_dimensions,
+                                   distance_threshold,
+                                   max_memory,
+                                   neighbour_cache)
+        for f in fan_works:
+            before = search_stats(ann_index)
+            records = ann_index.search(f)
+            yield f, records, search_stats(ann_index) - before
+        return
+
+    with multiprocessing.Pool(processes=workers,
+                              initializer=init_search_worker,
+                              initargs=(original_script_markups, max_memory,
+                                        neighbour_cache, share_cache)) as pool:
+        for f, records, stats, new_entries in pool.imap_unordered(
+                search_file, fan_works, chunksize=1):
+            for key, matches in new_entries:
+                neighbour_cache.put(key, matches)
+            yield f, records, stats
+
+def load_search_checkpoint(filename, fingerprint):
+    # A checkpoint lists the batch files written so far and the works
+    # in each. It is only used if it was made with the same scripts.
+    if os.path.exists(filename):
+        with open(filename, encoding='utf-8') as ip:
+            checkpoint = json.load(ip)
+        if checkpoint['fingerprint'] == json.loads(json.dumps(fingerprint)):
+            return checkpoint
+        print('Ignoring checkpoint {}: it was made for other '
+              'scripts or settings.'.format(filename))
+    return {'fingerprint': fingerprint, 'batches': []}
+
+def save_search_checkpoint(checkpoint, filename):
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w', encoding='utf-8') as out:
+        json.dump(checkpoint, out, indent=2)
+    os.replace(tmp_filename, filename)
+
+def work_list_digest(fan_works):
+    # Identifies a list of works by their filenames, whatever
+    # directory they were listed from.
+    names = sorted(os.path.basename(f) for f in fan_works)
+    return hashlib.sha1('\n'.join(names).encode('utf-8')).hexdigest()
+
+def write_shard_manifest(fan_works, shard, records_filename, filename,
+                         skipped_works=(), fingerprint=None, all_works=()):
+    # The manifest is written only after the shard's records, so
+    # its presence means the shard finished.
+    shard_index, num_shards = shard
+    manifest = {'shard': shard_index,
+                'num_shards': num_shards,
+                'window_size': window_size,
+                'fingerprint': fingerprint,
+                # The works to be split between all the shards, so 
+                # that merge can check none were left out.
+                'all_works_count': len(all_works),
+                'all_works_digest': work_list_digest(all_works),
+                'records': os.path.basename(records_filename),
+                'fan_works': sorted(fan_works),
+                'skipped_works': sorted(skipped_works)}
+    with open(filename, 'w', encoding='utf-8') as out:
+        json.dump(manifest, out, indent=2)
+
 def analyze(inputs):
     fan_work_directory = inputs['d']
-    original_script_markup = inputs['s']
+    original_script_markups = inputs['s']
+    shard = inputs.get('shard')
+    max_memory = inputs['max_memory']
+    workers = inputs.get('workers') or multiprocessing.cpu_count()
+    cluster_size = inputs.get('cluster_size') or 500
+    duplicate_report = inputs.get('skip_duplicates')
+    cache_file = inputs.get('neighbour_cache')
+    cache_size = inputs.get('neighbour_cache_size') or neighbour_cache_size
     
     fan_works = os.listdir(fan_work_directory)
+    skipped_works = []
+    if inputs.get('where'):
+        selected = select_works(inputs['meta_db'], inputs['where'])
+        skipped_works = [f for f in fan_works if work_id(f) not in selected]
+        fan_works = [f for f in fan_works if work_id(f) in selected]
+    if duplicate_report:
+        duplicates = load_duplicates(duplicate_report)
+        skipped_works += [f for f in fan_works if f in duplicates]
+        fan_works = [f for f in fan_works if f not in duplicates]
     fan_works = [os.path.join(fan_work_directory, f) 
                  for f in fan_works]   
-    random.seed(4815162342)  # This will always generate the same "random" sample.
-    random.shuffle(fan_works)
-      
-    cluster_size = 500
-    start = 0
-    fan_clusters = [fan_works[i:i + cluster_size] for i in range(start, len(fan_works), cluster_size)]
-    
+
     filename_base = 'match-{}gram{{}}'.format(window_size)
+    all_works = fan_works
+    if shard is not None:
+        fan_works = shard_fan_works(fan_works, *shard)
+        filename_base = filename_base.format('-shard-{}of{}{{}}'.format(*shard))
+
     batch_filename = filename_base.format('-batch-{}.csv')
+    checkpoint_filename = filename_base.format('-checkpoint.json')
     
+    fingerprint = index_fingerprint(original_script_markups)
+    if cache_file:
+        neighbour_cache = NeighbourCache.load(cache_file, cache_size,
+                                              fingerprint=fingerprint)
+    else:
+        neighbour_cache = NeighbourCache(cache_size, fingerprint=fingerprint)
+
+    # Works in a checkpoint from an earlier, interrupted run 
+    # are not searched again; their records are read back from
+    # the batch files.
+    checkpoint = load_search_checkpoint(checkpoint_filename, fingerprint)
     accumulated_records = [new_record_structure['fields']]
-    for i, fan_cluster in enumerate(fan_clusters, start=start):
-        with multiprocessing.Pool(processes=5) as pool:
-            ann_index = AnnIndexSearch(original_script_markup, 
-                                       window_size, 
-                                       number_of_hashes, 
-                                       hash_dimensions,
-                                       distance_threshold)
-            #records = find_matches_multi(fan_cluster, ann_index, pool)
-            records = find_matches(fan_cluster, ann_index, pool)
-            write_records(records, batch_filename.format(i))
-            accumulated_records.extend(records)
-    
-    i = 0
-    today_str = '-{:%Y%m%d}.csv'.format(datetime.date.today())
-    name_check = filename_base.format(today_str)
-    while os.path.exists(name_check):
-        i += 1
-        today_str = '-{:%Y%m%d}-{}.csv'.format(datetime.date.today(), i)
-        name_check = filename_base.format(today_str)
+    done = set()
+    for batch in checkpoint['batches']:
+        # Works may have been filtered out since the checkpoint.
+        batch_works = set(batch['fan_works']).intersection(fan_works)
+        accumulated_records.extend(r for r in read_records(batch['records'])
+                                   if r[0] in batch_works)
+        done.update(batch_works)
+    if done:
+        print('Resuming from {}: {} works already searched.'.format(
+            checkpoint_filename, len(done)))
+
+    # Every `cluster_size` finished works are written to a batch
+    # file, which is then added to the checkpoint. Both are replaced
+    # atomically, so a crash loses at most the works since the
+    # last batch.
+    remaining = schedule_fan_works([f for f in fan_works if f not in done])
+    cluster, cluster_records, stats = [], [], Counter()
+    results = scheduled_search(remaining, original_script_markups, workers,
+                               max_memory, neighbour_cache, 
+                               share_cache=bool(cache_file))
+    for n, (f, records, work_stats) in enumerate(results, start=1):
+        cluster.append(f)
+        cluster_records.extend(records)
+        stats.update(work_stats)
+        if len(cluster) == cluster_size or n == len(remaining):
+            i = len(checkpoint['batches'])
+            tmp_filename = batch_filename.format(i) + '.tmp'
+            write_records([new_record_structure['fields']] + cluster_records, 
+                          tmp_filename)
+            os.replace(tmp_filename, batch_filename.format(i))
+            checkpoint['batches'].append({'records': batch_filename.format(i),
+                                          'fan_works': cluster})
+            save_search_checkpoint(checkpoint, checkpoint_filename)
+            accumulated_records.extend(cluster_records)
+
+            lookups = stats['cache_hits'] + stats['cache_misses']
+            print('Cluster {}: {} windows, {} pruned, {} exact matches, '
+                  '{:.1%} neighbour cache hits'.format(
+                      i, stats['windows'], stats['pruned'], stats['exact'], 
+                      stats['cache_hits'] / lookups if lookups else 0.0))
+            cluster, cluster_records, stats = [], [], Counter()
+
+    if cache_file:
+        neighbour_cache.save(cache_file)
     
-    write_records(accumulated_records, 
-                  name_check)
+    if shard is None:
+        records_filename = dated_filename(filename_base)
+        write_records(accumulated_records, records_filename)
+    else:
+        # Shard outputs have fixed names so that `merge` can find
+        # them; the dated name is given to the merged file.
+        records_filename = filename_base.format('.csv')
+        write_records(accumulated_records, records_filename)
+        write_shard_manifest(fan_works, shard, records_filename,
+                             filename_base.format('.json'), skipped_works,
+                             fingerprint, all_works)
+
+    # The run is complete, so a later run should start afresh.
+    if os.path.exists(checkpoint_filename):
+        os.remove(checkpoint_filename)
+    return records_filename
+
+def merge_shards(inputs):
+    manifest_files = inputs['i']
+    fan_work_directory = inputs['d']
+
+    manifests = []
+    for manifest_file in manifest_files:
+        with open(manifest_file, encoding='utf-8') as ip:
+            manifest = json.load(ip)
+        manifest['path'] = manifest_file
+        manifests.append(manifest)
+
+    problems = []
+    for key in ['num_shards', 'window_size']:
+        values = sorted(set(m[key] for m in manifests))
+        if len(values) != 1:
+            problems.append('Shards disagree on {}: {}'.format(key, values))
+
+    # The fingerprint identifies the scripts and search settings.
+    fingerprints = set(json.dumps(m.get('fingerprint')) for m in manifests)
+    if len(fingerprints) != 1:
+        problems.append('Shards were searched with different scripts or '
+                        'settings: {}'.format(sorted(fingerprints)))
+
+    num_shards = max(m['num_shards'] for m in manifests)
+    shard_counts = Counter(m['shard'] for m in manifests)
+    missing_shards = [i for i in range(num_shards) if i not in shard_counts]
+    if missing_shards:
+        problems.append('Missing shards: {}'.format(missing_shards))
+    repeated_shards = sorted(i for i, c in shard_counts.items() if c > 1)
+    if repeated_shards:
+        problems.append('Shards given more than once: {}'.format(repeated_shards))
+
+    work_counts = Counter(f for m in manifests for f in m['fan_works'])
+    duplicate_works = sorted(f for f, c in work_counts.items() if c > 1)
+    if duplicate_works:
+        problems.append('Works searched in more than one shard: {}'.format(
+            duplicate_works))
+
+    # Every shard records the full list of works it was split from,
+    # so missing works are found even without `-d`, e.g. when nodes
+    # listed the directory differently.
+    work_lists = set((m.get('all_works_count'), m.get('all_works_digest'))
+                     for m in manifests)
+    if len(work_lists) != 1:
+        problems.append('Shards were split from different lists of works: '
+                        '{}'.format(sorted(str(c) for c, d in work_lists)))
+    else:
+        count, digest = work_lists.pop()
+        if (len(work_counts), work_list_digest(work_counts)) != (count, digest):
+            problems.append('Shards cover {} distinct works, not the {} works '
+                            'they were split from'.format(len(work_counts), count))
+
+    if fan_work_directory:
+        expected = set(os.listdir(fan_work_directory))
+        searched = set(os.path.basename(f) for f in work_counts)
+        searched.update(f for m in manifests for f in m.get('skipped_works', []))
+        if expected - searched:
+            problems.append('Works not searched in any shard: {}'.format(
+                sorted(expected - searched)))
+        if searched - expected:
+            problems.append('Works not in {}: {}'.format(
+                fan_work_directory, sorted(searched - expected)))
+
+    accumulated_records = [new_record_structure['fields']]
+    for m in sorted(manifests, key=itemgetter('shard')):
+        records_filename = os.path.join(os.path.dirname(m['path']),
+                                        m['records'])
+        with open(records_filename, encoding='utf-8') as ip:
+            rows = list(csv.reader(ip))
+        if not rows or rows[0] != new_record_structure['fields']:
+            problems.append('{} does not have a record header'.format(
+                records_filename))
+            continue
+
+        shard_works = set(m['fan_works'])
+        strays = sorted(set(r[0] for r in rows[1:]) - shard_works)
+        if strays:
+            problems.append('{} has records for works outside its '
+                            'shard: {}'.format(records_filename, strays))
+        accumulated_records.extend(rows[1:])
+
+    if problems:
+        raise ValueError('Shards could not be merged:\n' + '\n'.join(problems))
+
+    filename_base = 'match-{}gram{{}}'.format(manifests[0]['window_size'])
+    records_filename = dated_filename(filename_base)
+    write_records(accumulated_records, records_filename)
+    return records_filename
 
 #----------------
 #SCRAPE FUNCTIONS
@@ -688,34 +1521,254 @@ def scrape(io):
             reset_display()  
             end = end + 1
 
+# ---------------------------
+# near-duplicate functions
+# ---------------------------
+def shingle_hashes(text, shingle_size):
+    words = re.findall(r'\w+', text.lower())
+    shingles = set(' '.join(words[i:i + shingle_size])
+                   for i in range(max(len(words) - shingle_size + 1, 1)))
+    return numpy.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles),
+                          dtype=numpy.uint64, count=len(shingles))
+
+class MinHasher(object):
+    # MinHash signatures using multiply-shift hashing, `(a * x + b) >> 32`
+    # in wrapping 64-bit arithmetic, with a random odd `a` per permutation.
+    def __init__(self, num_perm, seed, chunk_size=10000):
+        rng = numpy.random.RandomState(seed % 2 ** 32)
+        high = numpy.iinfo(numpy.int64).max
+        self.a = rng.randint(0, high, size=num_perm, dtype=numpy.int64).astype(numpy.uint64)
+        self.a |= numpy.uint64(1)
+        self.b = rng.randint(0, high, size=num_perm, dtype=numpy.int64).astype(numpy.uint64)
+        self.chunk_size = chunk_size
+
+    def signature(self, hashes):
+        signature = numpy.full(len(self.a), numpy.iinfo(numpy.uint32).max,
+                               dtype=numpy.uint64)
+        for start in range(0, len(hashes), self.chunk_size):
+            chunk = hashes[start:start + self.chunk_size]
+            permuted = self.a[:, None] * chunk[None, :] + self.b[:, None]
+            permuted >>= numpy.uint64(32)
+            numpy.minimum(signature, permuted.min(axis=1), out=signature)
+        return signature.astype(numpy.uint32)
+
+def duplicate_clusters(signatures, bands, threshold):
+    # Group works whose signatures agree in at least `threshold` of
+    # their positions. Only works that share a bucket in some band
+    # are compared, and each is compared with one member of each
+    # cluster already in the bucket, so the cost stays close to
+    # linear in the number of works.
+    names = sorted(signatures)
+    parent = list(range(len(names)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    rows = len(signatures[names[0]]) // bands if names else 0
+    for band in range(bands):
+        buckets = defaultdict(list)
+        for i, name in enumerate(names):
+            key = signatures[name][band * rows:(band + 1) * rows].tobytes()
+            buckets[key].append(i)
+
+        for members in buckets.values():
+            roots = []
+            for i in members:
+                for j in roots:
+                    if find(i) == find(j):
+                        break
+                    similarity = (signatures[names[i]] == signatures[names[j]]).mean()
+                    if similarity >= threshold:
+                        parent[find(i)] = find(j)
+                        break
+                else:
+                    roots.append(i)
+
+    clusters = defaultdict(list)
+    for i, name in enumerate(names):
+        clusters[find(i)].append(name)
+    return [c for c in clusters.values() if len(c) > 1]
+
+def load_duplicates(filename):
+    # The fan works a duplicate report marks to be skipped.
+    with open(filename, encoding='utf-8') as ip:
+        return set(r['FILENAME'] for r in csv.DictReader(ip)
+                   if r['REPRESENTATIVE'] == 'False')
+
+def find_duplicates(inputs):
+    fan_work_directory = inputs['d']
+    out_file = inputs['o']
+    threshold = inputs['t']
+
+    hasher = MinHasher(minhash_permutations, minhash_seed)
+    signatures = {}
+    sizes = {}
+    for f in os.listdir(fan_work_directory):
+        path = os.path.join(fan_work_directory, f)
+        with open(path, encoding='utf8') as fan_file:
+            signatures[f] = hasher.signature(shingle_hashes(fan_file.read(), 
+                                                            shingle_size))
+        sizes[f] = os.path.getsize(path)
+
+    clusters = duplicate_clusters(signatures, minhash_bands, threshold)
+
+    # The longest copy of each work is searched; the others are skipped.
+    rows = []
+    for cluster_id, cluster in enumerate(clusters):
+        representative = max(cluster, key=lambda f: (sizes[f], f))
+        for f in sorted(cluster):
+            similarity = (signatures[f] == signatures[representative]).mean()
+            rows.append([cluster_id, f, f == representative, 
+                         '{:.3f}'.format(similarity)])
+
+    with open(out_file, 'w', encoding='utf-8') as out:
+        wr = csv.writer(out)
+        wr.writerow(['CLUSTER', 'FILENAME', 'REPRESENTATIVE', 'ESTIMATED_SIMILARITY'])
+        wr.writerows(rows)
+
+    print('{} works, {} duplicate clusters, {} duplicates to skip'.format(
+        len(signatures), len(clusters), len(rows) - len(clusters)))
+
 # ----------------
 # matrix functions
 # ----------------
 class StrictNgramDedupe(object):
-    def __init__(self, data_path, ngram_size):
+    # The segmented spans of each work and the n-gram start counts are
+    # kept between batches, so that `update` with a new batch of search
+    # results only segments the new works and re-filters the spans
+    # whose neighbourhood of start counts changed. The state can be
+    # saved with `save` and restored with `load`.
+    def __init__(self, data_path, ngram_size, script_id=None, works=None):
         self.ngram_size = ngram_size
+        self.script_id = script_id
+        self.works = works
 
+        # Use n-gram starting index as a unique identifier.
+        self.starts_counter = collections.Counter()
+        self.work_spans = {}
+        self.span_index = collections.defaultdict(set)
+        self.span_results = {}
+        self.lex_cache = {}
+        self.update(data_path)
+
+    @classmethod
+    def load(cls, state_path):
+        # The state is saved as plain dicts and lists rather than as
+        # a pickled object, so it can be loaded whether this module 
+        # runs as a script or is imported. The span index is rebuilt.
+        with open(state_path, 'rb') as ip:
+            state = pickle.load(ip)
+        if not isinstance(state, dict):
+            raise ValueError('{} was saved by an older version; remove it to '
+                             'start a new state.'.format(state_path))
+
+        dd = cls.__new__(cls)
+        dd.ngram_size = state['ngram_size']
+        dd.script_id = state['script_id']
+        dd.works = set(state['works']) if state['works'] is not None else None
+        dd.starts_counter = collections.Counter(state['starts_counter'])
+        dd.work_spans = state['work_spans']
+        dd.span_results = state['span_results']
+        dd.lex_cache = state['lex_cache']
+        dd.span_index = collections.defaultdict(set)
+        for filename, spans in dd.work_spans.items():
+            for span_no, span in enumerate(spans):
+                for start in dd.to_ngram_starts([span]):
+                    dd.span_index[start].add((filename, span_no))
+        return dd
+
+    def save(self, state_path):
+        state = {'ngram_size': self.ngram_size,
+                 'script_id': self.script_id,
+                 'works': sorted(self.works) if self.works is not None else None,
+                 'starts_counter': dict(self.starts_counter),
+                 'work_spans': self.work_spans,
+                 'span_results': self.span_results,
+                 'lex_cache': self.lex_cache}
+
+        # Write to a temporary file first so that an interrupted
+        # save never leaves a truncated state behind.
+        tmp_path = state_path + '.tmp'
+        with open(tmp_path, 'wb') as op:
+            pickle.dump(state, op, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, state_path)
+
+    def read_rows(self, data_path):
         with open(data_path, encoding='UTF8') as ip:
             rows = list(csv.DictReader(ip))
-        self.data = rows
-        self.work_matches = collections.defaultdict(list)
-
-        for r in rows:
-            self.work_matches[r['FAN_WORK_FILENAME']].append(r)
 
-        # Use n-gram starting index as a unique identifier.
-        self.starts_counter = collections.Counter(
-            start
-            for matches in self.work_matches.values()
-            for start in self.to_ngram_starts(self.segment_full(matches))
-        )
-
-        filtered_matches = [self.top_ngram(span)
-                            for matches in self.work_matches.values()
-                            for span in self.segment_full(matches)]
+        # Script word indices are only comparable within a single
+        # script, so results from a multi-script search are
+        # deduplicated one script at a time.
+        if self.script_id is not None:
+            rows = [r for r in rows if r.get('ORIGINAL_SCRIPT_ID') == self.script_id]
+        else:
+            check_single_script(set(r.get('ORIGINAL_SCRIPT_ID') for r in rows),
+                                data_path)
+
+        # `works`, if given, is the set of work ids to keep.
+        if self.works is not None:
+            rows = [r for r in rows if work_id(r['FAN_WORK_FILENAME']) in self.works]
+        return rows
+
+    def update(self, data_path):
+        # Add a batch of search results. Works already seen are
+        # replaced by their new results.
+        work_matches = collections.defaultdict(list)
+        for r in self.read_rows(data_path):
+            work_matches[r['FAN_WORK_FILENAME']].append(r)
+
+        changed = set()
+        for filename, matches in work_matches.items():
+            if filename in self.work_spans:
+                self.remove_work(filename, changed)
+
+            spans = self.segment_full(matches)
+            self.work_spans[filename] = spans
+            for span_no, span in enumerate(spans):
+                key = (filename, span_no)
+                self.span_results[key] = None
+                for start in self.to_ngram_starts([span]):
+                    self.span_index[start].add(key)
+                    self.starts_counter[start] += 1
+                    changed.add(start)
+
+        for key in self.affected_spans(changed):
+            self.filter_span(key)
+
+    def remove_work(self, filename, changed):
+        spans = self.work_spans.pop(filename)
+        for span_no, span in enumerate(spans):
+            key = (filename, span_no)
+            del self.span_results[key]
+            for start in self.to_ngram_starts([span]):
+                self.span_index[start].discard(key)
+                self.starts_counter[start] -= 1
+                if not self.starts_counter[start]:
+                    del self.starts_counter[start]
+                changed.add(start)
+
+    def affected_spans(self, changed):
+        # A span's top n-gram, and whether a better match overlaps it,
+        # depend only on start counts within `ngram_size - 1` words 
+        # of the span's own starts.
+        affected = set()
+        for start in changed:
+            for ix in range(start - self.ngram_size + 1, start + self.ngram_size):
+                affected.update(self.span_index.get(ix, ()))
+        return affected
+
+    def filter_span(self, key):
+        filename, span_no = key
+        ng = self.top_ngram(self.work_spans[filename][span_no])
+        self.span_results[key] = ng if self.no_better_match(ng) else None
 
-        self.filtered_matches = [ng for ng in filtered_matches
-                                 if self.no_better_match(ng)]
+    @property
+    def filtered_matches(self):
+        return [ng for ng in self.span_results.values() if ng is not None]
 
     def num_ngrams(self):
         return len(set(int(ng[0]['ORIGINAL_SCRIPT_WORD_INDEX'])
@@ -763,7 +1816,7 @@ class StrictNgramDedupe(object):
         phrases = sorted_phrases
         
         if emolex:
-            emo_count = [emolex.lex_count(p) for p in phrases]
+            emo_count = [self.lex_count('emolex', emolex, p) for p in phrases]
             emo_sent_count = self.project_sentiment_keys(emo_count,
                                                          ['NEGATIVE', 'POSITIVE'])
             emo_emo_count = self.project_sentiment_keys(emo_count,
@@ -776,12 +1829,12 @@ class StrictNgramDedupe(object):
                                                          'FEAR',
                                                          'JOY'])
         
-        bing_count = [bing.lex_count(p) for p in phrases]
+        bing_count = [self.lex_count('bing', bing, p) for p in phrases]
         bing_count = self.project_sentiment_keys(bing_count,
                                                  ['NEGATIVE', 'POSITIVE'])
         
         if liwc:
-            liwc_count = [liwc.lex_count(p) for p in phrases]
+            liwc_count = [self.lex_count('liwc', liwc, p) for p in phrases]
             liwc_sent_count = self.project_sentiment_keys(liwc_count,
                                                           ['POSEMO', 'NEGEMO'])
             liwc_other_keys = set(k for ct in liwc_count for k in ct.keys())
@@ -830,6 +1883,13 @@ class StrictNgramDedupe(object):
             wr.writeheader()
             wr.writerows(rows)
 
+    def lex_count(self, lexicon_name, lexicon, phrase):
+        # Phrases are scored once and remembered across updates.
+        key = (lexicon_name, phrase)
+        if key not in self.lex_cache:
+            self.lex_cache[key] = lexicon.lex_count(phrase)
+        return self.lex_cache[key]
+
     def project_sentiment_keys(self, counts, keys):
         counts = [{k: ct.get(k, 0) for k in keys}
                   for ct in counts]
@@ -909,13 +1969,30 @@ def process(inputs):
     ngram_size = inputs['n']
     in_file = inputs['i']
     out_prefix = inputs['m']
+    script_id = inputs.get('s')
+    state_file = inputs.get('state')
+    works = None
+    if inputs.get('where'):
+        works = select_works(inputs['meta_db'], inputs['where'])
     
     matrix_out = '{}-most-common-perfect-matches-no-overlap-{}-gram-match-matrix.csv'.format(out_prefix, ngram_size)
     sentiment_out = '{}-most-common-perfect-matches-no-overlap-{}-gram-sentiment.csv'.format(out_prefix, ngram_size)
 
-    dd = StrictNgramDedupe(in_file, ngram_size=ngram_size)
+    if state_file and os.path.exists(state_file):
+        dd = StrictNgramDedupe.load(state_file)
+        if (dd.ngram_size, dd.script_id, dd.works) != (ngram_size, script_id, works):
+            raise ValueError('{} was built with n-gram size {}, script id {} and '
+                             'a different work filter'.format(
+                                 state_file, dd.ngram_size, dd.script_id))
+        dd.update(in_file)
+    else:
+        dd = StrictNgramDedupe(in_file, ngram_size=ngram_size, script_id=script_id,
+                               works=works)
     #print(dd.num_ngrams())
 
+    if state_file:
+        dd.save(state_file)
+
     dd.write_match_work_count_matrix(matrix_out)
     dd.write_match_sentiment(sentiment_out)
 
@@ -932,56 +2009,587 @@ def project_sentiment_keys_shortform(counts, keys):
                 ct['UNDETERMINED'] = 0
         return counts
 
+def add_column_group(columns, counts):
+    # Append one column per key of the `counts` dicts to the list of
+    # `(name, values)` pairs in `columns`. Clashing names are renamed
+    # as `pd.merge` did when the lexicons were joined one at a time:
+    # the earlier column gets `_x` and the new one `_y`.
+    names = [name for name, values in columns]
+    keys = list(counts[0]) if counts else []
+    for k in keys:
+        name = k
+        if name in names:
+            i = names.index(name)
+            names[i] = name + '_x'
+            columns[i] = (names[i], columns[i][1])
+            name = name + '_y'
+        columns.append((name, [ct[k] for ct in counts]))
+        names.append(name)
+
+def lexicon_columns(prefix, counts):
+    # `(name, values)` pairs for the tiles, named by lexicon group
+    # as in `write_match_sentiment`, so that no two clash.
+    keys = list(counts[0]) if counts else []
+    return [(prefix + k, [ct[k] for ct in counts]) for k in keys]
+
+def count_script_matches(filename, n_words, script_id=None, chunksize=1000000):
+    # Number of matches of each script word in a search output csv,
+    # read in chunks. Only matches with the given script id are
+    # counted if the file has an `ORIGINAL_SCRIPT_ID` column.
+    header = pd.read_csv(filename, nrows=0).columns
+    usecols = ['ORIGINAL_SCRIPT_WORD_INDEX']
+    if 'ORIGINAL_SCRIPT_ID' in header:
+        usecols.append('ORIGINAL_SCRIPT_ID')
+
+    counts = numpy.zeros(n_words, dtype=numpy.int64)
+    for chunk in pd.read_csv(filename, usecols=usecols, chunksize=chunksize,
+                             dtype={'ORIGINAL_SCRIPT_ID': str}):
+        if 'ORIGINAL_SCRIPT_ID' in chunk:
+            chunk = chunk[chunk['ORIGINAL_SCRIPT_ID'] == script_id]
+        word_indices = chunk['ORIGINAL_SCRIPT_WORD_INDEX'].values
+        word_indices = word_indices[(word_indices >= 0) & (word_indices < n_words)]
+        counts += numpy.bincount(word_indices, minlength=n_words)
+    return counts
+
+def sum_tiles(values, starts):
+    # Sum each row of `values` over the bins beginning at `starts`.
+    if not len(starts):
+        return [[] for row in values]
+    return numpy.add.reduceat(values, starts, axis=1).tolist()
+
+def write_format_tiles(scenes, names, values, filename):
+    # Pre-aggregated totals of each column in `names`, per scene and
+    # per fixed-size window of script words at each resolution in
+    # `tile_resolutions`, so the visualization need not load and bin 
+    # the per-word file.
+    n_words = values.shape[1]
+    scene_starts = [i for i in range(n_words) 
+                    if i == 0 or scenes[i] != scenes[i - 1]]
+    tiles = {
+        'words': n_words,
+        'columns': names,
+        'scenes': {
+            'scene': [None if pd.isnull(scenes[i]) else int(scenes[i])
+                      for i in scene_starts],
+            'start': scene_starts,
+            'end': scene_starts[1:] + [n_words],
+            'values': sum_tiles(values, scene_starts)
+        },
+        'windows': [
+            {'size': size,
+             'start': list(range(0, n_words, size)),
+             'values': sum_tiles(values, list(range(0, n_words, size)))}
+            for size in tile_resolutions
+        ]
+    }
+    with open(filename, 'w', encoding='utf-8') as out:
+        json.dump(tiles, out, separators=(',', ':'))
+
 def format_data(io):
     fin = io['s']
     fout = io['o']
+    matches_file = io.get('m')
     
     markup_script = load_markup_script(fin)
     markup_script = markup_script[1:]
     list_script = [[i] + r for i, r in enumerate(markup_script)]
-      
-    csv_script = pd.DataFrame(list_script)
-    csv_script.columns = ['ORIGINAL_SCRIPT_INDEX', 
-       'LOWERCASE', 
-       'SPACY_ORTH_ID', 
-       'SCENE',
-       'CHARACTER']
+
+    # The per-word columns are assembled in order and turned into
+    # a data frame once, rather than merged lexicon by lexicon.
+    script_cols = ['ORIGINAL_SCRIPT_INDEX', 
+                   'LOWERCASE', 
+                   'SPACY_ORTH_ID', 
+                   'SCENE',
+                   'CHARACTER']
+    columns = [(name, [r[i] for r in list_script]) 
+               for i, name in enumerate(script_cols)]
+    words = [j[1] for j in list_script]
     
-    bing_count = [bing.lex_count(j[1]) for j in list_script]
+    bing_count = [bing.lex_count(w) for w in words]
     bing_sentiment_keys = ['NEGATIVE', 'POSITIVE']
     bing_count = project_sentiment_keys_shortform(bing_count, bing_sentiment_keys)
-    bing_DF = pd.DataFrame(bing_count)
-    
-    bing_DF['ORIGINAL_SCRIPT_INDEX'] = csv_script['ORIGINAL_SCRIPT_INDEX']
-    out = pd.merge(csv_script, bing_DF, on='ORIGINAL_SCRIPT_INDEX')
+    add_column_group(columns, bing_count)
+    tile_columns = lexicon_columns('BING_', bing_count)
     
     if emolex:
-        emo_count = [emolex.lex_count(j[1]) for j in list_script]
+        emo_count = [emolex.lex_count(w) for w in words]
         emo_sentiment_keys = ['ANTICIPATION', 'ANGER', 'TRUST', 'SADNESS','DISGUST',
                           'SURPRISE', 'FEAR', 'JOY', 'NEGATIVE', 'POSITIVE']
         emo_count = project_sentiment_keys_shortform(emo_count, emo_sentiment_keys)
-        emo_DF = pd.DataFrame(emo_count)
-        emo_DF['ORIGINAL_SCRIPT_INDEX'] = csv_script['ORIGINAL_SCRIPT_INDEX']
-        out = pd.merge(out, emo_DF, on='ORIGINAL_SCRIPT_INDEX')
+        add_column_group(columns, emo_count)
+        tile_columns.extend(lexicon_columns('NRC_', emo_count))
       
     if liwc:
-        liwc_count = [liwc.lex_count(j[1]) for j in list_script]
+        liwc_count = [liwc.lex_count(w) for w in words]
         
         liwc_sentiment_keys = ['POSEMO', 'NEGEMO']
         liwc_sent_count = project_sentiment_keys_shortform(liwc_count, liwc_sentiment_keys)
-        liwc_sent_DF = pd.DataFrame(liwc_sent_count)
-        liwc_sent_DF['ORIGINAL_SCRIPT_INDEX'] = csv_script['ORIGINAL_SCRIPT_INDEX']
-        out = pd.merge(out, liwc_sent_DF, on='ORIGINAL_SCRIPT_INDEX')
+        add_column_group(columns, liwc_sent_count)
+        tile_columns.extend(lexicon_columns('LIWC_SENTIMENT_', liwc_sent_count))
         
         liwc_other_keys = set(k for ct in liwc_count for k in ct.keys())
         liwc_other_keys -= set(['POSEMO', 'NEGEMO']) #already used these
         liwc_other_count = project_sentiment_keys_shortform(liwc_count, liwc_other_keys)
-        liwc_other_DF = pd.DataFrame(liwc_other_count)
-        liwc_other_DF['ORIGINAL_SCRIPT_INDEX'] = csv_script['ORIGINAL_SCRIPT_INDEX']
-        out = pd.merge(out, liwc_other_DF, on='ORIGINAL_SCRIPT_INDEX')
+        add_column_group(columns, liwc_other_count)
+        tile_columns.extend(lexicon_columns('LIWC_ALL_OTHER_', liwc_other_count))
     
+    out = pd.DataFrame({i: values for i, (name, values) in enumerate(columns)},
+                       index=range(len(list_script)))
+    out.columns = [name for name, values in columns]
     out.to_csv(fout + '.csv', index=False)
 
+    names = [name for name, values in tile_columns]
+    values = numpy.array([values for name, values in tile_columns], 
+                         dtype=numpy.int64).reshape(len(tile_columns), len(list_script))
+    if matches_file:
+        match_counts = count_script_matches(matches_file, len(list_script),
+                                            script_id_from_filename(fin))
+        names.append('MATCHES')
+        values = numpy.vstack([values, match_counts])
+    write_format_tiles(columns[script_cols.index('SCENE')][1], names, values,
+                       fout + '-tiles.json')
+
+# ---------------------
+# search server functions
+# ---------------------
+class SearchServer(object):
+    # Runs searches on a single worker thread that owns the index.
+    # Requests that arrive while a batch is running are queued and
+    # then parsed together with `sp.pipe`.
+    def __init__(self, ann_index, batch_size=32):
+        self.ann_index = ann_index
+        self.batch_size = batch_size
+        self.jobs = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, works):
+        # `works` is a list of `(filename, text)` pairs. Blocks until
+        # they have been searched and returns their records.
+        job = {'works': works, 'done': threading.Event(),
+               'records': None, 'error': None}
+        self.jobs.put(job)
+        job['done'].wait()
+        if job['error'] is not None:
+            raise job['error']
+        return job['records']
+
+    def next_batch(self):
+        jobs = [self.jobs.get()]
+        while len(jobs) < self.batch_size:
+            try:
+                jobs.append(self.jobs.get_nowait())
+            except queue.Empty:
+                break
+        return jobs
+
+    def run(self):
+        while True:
+            jobs = self.next_batch()
+            works = [w for job in jobs for w in job['works']]
+            try:
+                docs = list(sp.pipe(text for filename, text in works))
+            except Exception:
+                # Parse each job on its own, so that one bad
+                # request doesn't fail the others.
+                docs = None
+
+            # Errors are kept to the job they happen in.
+            for job in jobs:
+                n_works = len(job['works'])
+                try:
+                    if docs is None:
+                        job_docs = sp.pipe(text for filename, text in job['works'])
+                    else:
+                        job_docs, docs = docs[:n_works], docs[n_works:]
+                    job['records'] = [r for (filename, text), doc 
+                                      in zip(job['works'], job_docs)
+                                      for r in self.ann_index.search_doc(doc, filename)]
+                except Exception as exc:
+                    job['error'] = exc
+                job['done'].set()
+
+def read_search_request(request):
+    # A request names fan work files with `"files": [...]`, or 
+    # sends text directly with `"texts": {"name": "text", ...}`.
+    if not isinstance(request, dict):
+        raise ValueError('A search request must be a JSON object.')
+    files = request.get('files', [])
+    texts = request.get('texts', {})
+    if not (isinstance(files, list) and all(isinstance(f, str) for f in files)):
+        raise ValueError('"files" must be a list of filenames.')
+    if not (isinstance(texts, dict) and all(isinstance(t, str) for t in texts.values())):
+        raise ValueError('"texts" must map names to texts.')
+
+    works = []
+    for filename in files:
+        with open(filename, encoding='utf8') as fan_file:
+            works.append((filename, fan_file.read()))
+    works.extend(sorted(texts.items()))
+    if not works:
+        raise ValueError('A search request needs "files" or "texts".')
+    return works
+
+class SearchRequestHandler(http.server.BaseHTTPRequestHandler):
+    def send_json(self, code, value):
+        # Values from numpy are converted to plain Python values.
+        body = json.dumps(value, default=lambda v: v.item()).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != '/search':
+            self.send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            works = read_search_request(request)
+        except (ValueError, OSError) as exc:
+            self.send_json(400, {'error': str(exc)})
+            return
+
+        try:
+            records = self.server.search_server.submit(works)
+        except Exception as exc:
+            self.send_json(500, {'error': str(exc)})
+            return
+        self.send_json(200, {'fields': new_record_structure['fields'],
+                             'records': records})
+
+def serve(inputs):
+    ann_index = AnnIndexSearch(inputs['s'],
+                               window_size,
+                               number_of_hashes,
+                               hash_dimensions,
+                               distance_threshold,
+                               inputs['max_memory'])
+    httpd = http.server.ThreadingHTTPServer((inputs['host'], inputs['port']),
+                                            SearchRequestHandler)
+    httpd.search_server = SearchServer(ann_index, inputs['batch_size'])
+    print('Serving searches on http://{}:{}/search'.format(inputs['host'], inputs['port']))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+# ------------------
+# pipeline functions
+# ------------------
+_stage_done = object()
+
+_pipeline_error_log = Logger(logfile='pipeline-errors.txt')
+log_pipeline_error = _pipeline_error_log.log
+
+def watch_directory(directory, follow=False, poll_interval=10, idle_timeout=600,
+                    extension='.html'):
+    # Yield each file in `directory` ending with `extension` once,
+    # skipping e.g. the logs scrape writes alongside its html files.
+    # If `follow` is set, keep
+    # watching for new files (e.g. from a running scrape) until none
+    # have appeared for `idle_timeout` seconds. A new file is only
+    # yielded once its size is unchanged between two polls, so works
+    # still being written are left for later.
+    seen = set()
+    sizes = {}
+    last_new = monotonic()
+    while True:
+        for f in sorted(os.listdir(directory)):
+            path = os.path.join(directory, f)
+            if f in seen or not f.endswith(extension) or not os.path.isfile(path):
+                continue
+            size = os.path.getsize(path)
+            if not follow or sizes.get(f) == size:
+                seen.add(f)
+                last_new = monotonic()
+                yield path
+            else:
+                sizes[f] = size
+
+        if not follow or monotonic() - last_new > idle_timeout:
+            return
+        sleep(poll_interval)
+
+def pipeline_source(paths, out_queue):
+    # The end marker is always sent, so that the stages and the
+    # writer stop even if listing the input directory fails.
+    try:
+        for path in paths:
+            out_queue.put(path)
+    except Exception as exc:
+        log_pipeline_error('Input stopped: {!r}'.format(exc))
+    finally:
+        out_queue.put(_stage_done)
+
+def pipeline_stage(func, in_queue, out_queue, n_threads):
+    # Start `n_threads` threads that apply `func` to each item from 
+    # `in_queue` and put the results, if not None, on `out_queue`.
+    # Both queues are bounded, so a slow stage holds back the ones
+    # before it. The last thread to finish passes on the end marker.
+    remaining = [n_threads]
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            item = in_queue.get()
+            if item is _stage_done:
+                in_queue.put(item)  # for the other threads
+                break
+            try:
+                result = func(item)
+            except Exception as exc:
+                log_pipeline_error('{}: {!r}'.format(item, exc))
+                result = None
+            if result is not None:
+                out_queue.put(result)
+
+        with lock:
+            remaining[0] -= 1
+            if not remaining[0]:
+                out_queue.put(_stage_done)
+
+    threads = [threading.Thread(target=work, daemon=True) for i in range(n_threads)]
+    for t in threads:
+        t.start()
+    return threads
+
+_worker_index = None
+
+def init_search_worker(original_script_markups, max_memory, neighbour_cache=None,
+                       share_cache=False):
+    global _worker_index
+    if share_cache:
+        neighbour_cache.track_new()
+    _worker_index = AnnIndexSearch(original_script_markups,
+                                   window_size,
+                                   number_of_hashes,
+                                   hash_dimensions,
+                                   distance_threshold,
+                                   max_memory,
+                                   neighbour_cache)
+
+def search_file(filename):
+    before = search_stats(_worker_index)
+    records = _worker_index.search(filename)
+    return (filename, records, search_stats(_worker_index) - before,
+            _worker_index.neighbour_cache.take_new())
+
+def search_text(filename, text):
+    return _worker_index.search_doc(sp(text), filename)
+
+def pipeline(inputs):
+    html_dir = inputs['i']
+    text_dir = inputs['o']
+    queue_size = inputs['queue_size']
+    clean_workers = inputs['clean_workers']
+    search_workers = inputs['search_workers']
+    work_timeout = inputs['work_timeout']
+
+    try:
+        os.makedirs(text_dir)
+    except Exception:
+        pass
+
+    html_queue = queue.Queue(maxsize=queue_size)
+    text_queue = queue.Queue(maxsize=queue_size)
+    record_queue = queue.Queue(maxsize=queue_size)
+
+    clean_pool = multiprocessing.Pool(processes=clean_workers)
+    search_pool = multiprocessing.Pool(processes=search_workers,
+                                       initializer=init_search_worker,
+                                       initargs=(inputs['s'], inputs['max_memory']))
+
+    # Results are awaited with a timeout, since a pool never returns
+    # the result of a work whose worker process was killed (e.g. when
+    # it ran out of memory); the work is logged as failed instead.
+    def clean(html_path):
+        try:
+            text = clean_pool.apply_async(get_fan_work, (html_path,)).get(work_timeout)
+        except multiprocessing.TimeoutError:
+            log_pipeline_error('{}: cleaning timed out'.format(html_path))
+            return None
+        if not text:
+            log_pipeline_error('{}: not converted'.format(html_path))
+            return None
+        base, ext = os.path.splitext(os.path.basename(html_path))
+        text_path = os.path.join(text_dir, base + '.txt')
+        with open(text_path, 'w', encoding='utf-8') as out:
+            out.write(text)
+        return text_path, text
+
+    def search(work):
+        try:
+            return search_pool.apply_async(search_text, work).get(work_timeout)
+        except multiprocessing.TimeoutError:
+            log_pipeline_error('{}: search timed out'.format(work[0]))
+            return None
+
+    # One thread per pool worker keeps every worker busy.
+    paths = watch_directory(html_dir, inputs['follow'], 
+                            inputs['poll'], inputs['idle'])
+    source = threading.Thread(target=pipeline_source, args=(paths, html_queue),
+                              daemon=True)
+    source.start()
+    pipeline_stage(clean, html_queue, text_queue, clean_workers)
+    pipeline_stage(search, text_queue, record_queue, search_workers)
+
+    records_filename = dated_filename('match-{}gram{{}}'.format(window_size))
+    n_works = 0
+    with open(records_filename, 'w', encoding='utf-8') as out:
+        wr = csv.writer(out)
+        wr.writerow(new_record_structure['fields'])
+        while True:
+            records = record_queue.get()
+            if records is _stage_done:
+                break
+            wr.writerows(records)
+            out.flush()
+            n_works += 1
+            display('Searched {} works;'.format(n_works))
+            reset_display()
+
+    # Every result has been collected, so the pools can be stopped
+    # outright; waiting on them would hang on a work that timed out.
+    clean_pool.terminate()
+    search_pool.terminate()
+    clean_pool.join()
+    search_pool.join()
+    print('Searched {} works; results in {}'.format(n_works, records_filename))
+    return records_filename
+
+# ---------------------
+# match store functions
+# ---------------------
+sqlite_types = {str: 'TEXT', int: 'INTEGER', float: 'REAL'}
+
+# Spacy orth ids are unsigned 64-bit hashes, too large for
+# sqlite's signed integers, so they are stored as text.
+match_store_text_fields = ['FAN_WORK_ORTH_ID', 'ORIGINAL_SCRIPT_ORTH_ID']
+
+match_store_indexes = ['ORIGINAL_SCRIPT_WORD_INDEX',
+                       'FAN_WORK_FILENAME',
+                       'ORIGINAL_SCRIPT_SCENE',
+                       'ORIGINAL_SCRIPT_CHARACTER',
+                       'BEST_COMBINED_DISTANCE']
+
+def store_row(row, fields, types):
+    # Convert a csv row to typed values; empty or missing
+    # values (e.g. lines before the first scene) become NULL.
+    return [t(row[f]) if row.get(f) not in (None, '') else None
+            for f, t in zip(fields, types)]
+
+def build_match_store(csv_filename, db_filename):
+    fields = new_record_structure['fields']
+    types = [str if f in match_store_text_fields else t
+             for f, t in zip(fields, new_record_structure['types'])]
+    columns = ', '.join('{} {}'.format(f, sqlite_types[t]) 
+                        for f, t in zip(fields, types))
+    insert = 'INSERT INTO matches VALUES ({})'.format(
+        ', '.join('?' for f in fields))
+
+    conn = sqlite3.connect(db_filename)
+    with conn:
+        conn.execute('DROP TABLE IF EXISTS matches')
+        conn.execute('CREATE TABLE matches ({})'.format(columns))
+        with open(csv_filename, encoding='utf-8') as ip:
+            conn.executemany(insert, (store_row(r, fields, types) 
+                                      for r in csv.DictReader(ip)))
+
+        # Indexes are built after loading, which is much faster
+        # than updating them row by row.
+        for f in match_store_indexes:
+            conn.execute('CREATE INDEX IF NOT EXISTS {0}_IX ON matches ({0})'.format(f))
+    conn.close()
+
+class MatchStore(object):
+    # Queries over a match store built by `build_match_store`. All
+    # filters are optional; `script_start` and `script_end` are
+    # inclusive, and `max_distance` is an upper bound on the 
+    # combined distance.
+    def __init__(self, db_filename):
+        self.conn = sqlite3.connect(db_filename)
+
+    def close(self):
+        self.conn.close()
+
+    def where(self, script_start=None, script_end=None, fan_work=None,
+              scene=None, character=None, max_distance=None, script_id=None):
+        conditions = [('ORIGINAL_SCRIPT_WORD_INDEX >= ?', script_start),
+                      ('ORIGINAL_SCRIPT_WORD_INDEX <= ?', script_end),
+                      ('FAN_WORK_FILENAME = ?', fan_work),
+                      ('ORIGINAL_SCRIPT_SCENE = ?', scene),
+                      ('ORIGINAL_SCRIPT_CHARACTER = ?', character),
+                      ('BEST_COMBINED_DISTANCE < ?', max_distance),
+                      ('ORIGINAL_SCRIPT_ID = ?', script_id)]
+        conditions = [(c, v) for c, v in conditions if v is not None]
+        clause = ' AND '.join(c for c, v in conditions)
+        clause = ' WHERE ' + clause if clause else ''
+        return clause, [v for c, v in conditions]
+
+    def matches(self, limit=None, **filters):
+        clause, params = self.where(**filters)
+        query = 'SELECT * FROM matches' + clause
+        query += ' ORDER BY FAN_WORK_FILENAME, FAN_WORK_WORD_INDEX'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        return [list(r) for r in self.conn.execute(query, params)]
+
+    def works(self, limit=None, **filters):
+        # Fan works with the number of matching words in each,
+        # most matches first.
+        clause, params = self.where(**filters)
+        query = ('SELECT FAN_WORK_FILENAME, COUNT(*) AS N FROM matches' + clause +
+                 ' GROUP BY FAN_WORK_FILENAME ORDER BY N DESC, FAN_WORK_FILENAME')
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        return [list(r) for r in self.conn.execute(query, params)]
+
+    def most_frequent_matches(self, n_matches, threshold, **filters):
+        # Like `most_frequent_matches`, without loading the records.
+        clause, params = self.where(max_distance=threshold, **filters)
+        query = ('SELECT ORIGINAL_SCRIPT_WORD_INDEX, COUNT(*) AS N, '
+                 'ORIGINAL_SCRIPT_WORD, ORIGINAL_SCRIPT_ID FROM matches' + clause + 
+                 ' GROUP BY ORIGINAL_SCRIPT_WORD_INDEX, ORIGINAL_SCRIPT_ID'
+                 ' ORDER BY N DESC, ORIGINAL_SCRIPT_WORD_INDEX LIMIT ?')
+        params.append(n_matches)
+        return [tuple(r) for r in self.conn.execute(query, params)]
+
+def make_store(inputs):
+    build_match_store(inputs['i'], inputs['o'])
+
+def query_store(inputs):
+    store = MatchStore(inputs['db'])
+    filters = {'script_start': inputs['words'][0] if inputs['words'] else None,
+               'script_end': inputs['words'][1] if inputs['words'] else None,
+               'fan_work': inputs['work'],
+               'scene': inputs['scene'],
+               'character': inputs['character'],
+               'script_id': inputs['script_id']}
+
+    wr = csv.writer(sys.stdout)
+    if inputs['top'] is not None:
+        wr.writerow(['ORIGINAL_SCRIPT_WORD_INDEX', 'COUNT', 'ORIGINAL_SCRIPT_WORD',
+                     'ORIGINAL_SCRIPT_ID'])
+        wr.writerows(store.most_frequent_matches(inputs['top'], 
+                                                 inputs['threshold'], **filters))
+    elif inputs['works']:
+        wr.writerow(['FAN_WORK_FILENAME', 'COUNT'])
+        wr.writerows(store.works(limit=inputs['limit'], 
+                                 max_distance=inputs['threshold'], **filters))
+    else:
+        wr.writerow(new_record_structure['fields'])
+        wr.writerows(store.matches(limit=inputs['limit'], 
+                                   max_distance=inputs['threshold'], **filters))
+    store.close()
+
 # -----------------------------------------------------------------------------
 # SCRIPT
 # ------
@@ -989,7 +2597,7 @@ def format_data(io):
 if __name__ == '__main__':
     
     parser = argparse.ArgumentParser(description='process fanworks scraped from Archive of Our Own.') 
-    subparsers = parser.add_subparsers(help='scrape, clean, getmeta, search, matrix, or format')
+    subparsers = parser.add_subparsers(help='scrape, clean, getmeta, dedupe, search, serve, pipeline, merge, matrix, format, store, or query')
     
     #sub-parsers
     scrape_parser = subparsers.add_parser('scrape', help='find and scrape fanfiction works from Archive of Our Own')
@@ -1009,23 +2617,90 @@ if __name__ == '__main__':
     meta_parser = subparsers.add_parser('getmeta', help='takes a directory of html files and yields a csv file containing metadata')
     meta_parser.add_argument('i', action='store', help='directory of input html files to process')
     meta_parser.add_argument('-o', action='store', default='fan-meta', help='filename for metadata csv file')
+    meta_parser.add_argument('--db', action='store', default=None, help='filename for an indexed sqlite metadata store to build as well')
     meta_parser.set_defaults(func=collect_meta)
     
+    dedupe_parser = subparsers.add_parser('dedupe', help='finds near-duplicate fanworks before searching')
+    dedupe_parser.add_argument('d', action='store', help='directory of fanwork text files')
+    dedupe_parser.add_argument('-o', action='store', default='duplicate-clusters.csv', help='filename for the duplicate cluster report')
+    dedupe_parser.add_argument('-t', action='store', type=float, default=duplicate_threshold, help='estimated similarity above which works are duplicates (default {})'.format(duplicate_threshold))
+    dedupe_parser.set_defaults(func=find_duplicates)
+    
     search_parser = subparsers.add_parser('search', help='compare fanworks with the original script')
     search_parser.add_argument('d', action='store', help='directory of fanwork text files')
-    search_parser.add_argument('s', action='store', help='filename for markup version of script')
+    search_parser.add_argument('s', action='store', nargs='+', help='filenames for markup versions of one or more scripts')
+    search_parser.add_argument('--max-memory', action='store', type=int, default=max_memory, help='megabytes of word vectors to hold per fan work in each process (default {})'.format(max_memory))
+    search_parser.add_argument('--neighbour-cache', action='store', default=None, help='file in which nearest neighbor results are kept between runs')
+    search_parser.add_argument('--neighbour-cache-size', action='store', type=int, default=neighbour_cache_size, help='maximum number of windows in the neighbour cache; each search process holds its own copy (default {})'.format(neighbour_cache_size))
+    search_parser.add_argument('--skip-duplicates', action='store', default=None, help='duplicate cluster report from dedupe; only one work per cluster is searched')
+    search_parser.add_argument('--where', action='store', default=None, help='metadata filter, e.g. \'language=English and published>=2016-01-01\'; requires --meta-db')
+    search_parser.add_argument('--meta-db', action='store', default=None, help='metadata store built by getmeta --db')
+    search_parser.add_argument('-w', '--workers', action='store', type=int, default=multiprocessing.cpu_count(), help='number of search processes')
+    search_parser.add_argument('-c', '--cluster-size', action='store', type=int, default=500, help='number of finished works written to each batch file and checkpoint')
+    search_parser.add_argument('--shard', action='store', type=parse_shard, default=None, help='search only shard i of N (zero-based), e.g. 0/4')
     search_parser.set_defaults(func=analyze)
+
+    serve_parser = subparsers.add_parser('serve', help='keeps the script index loaded and answers search requests over http')
+    serve_parser.add_argument('s', action='store', nargs='+', help='filenames for markup versions of one or more scripts')
+    serve_parser.add_argument('--host', action='store', default='127.0.0.1', help='address to listen on')
+    serve_parser.add_argument('--port', action='store', type=int, default=8000, help='port to listen on')
+    serve_parser.add_argument('--batch-size', action='store', type=int, default=32, help='maximum number of queued requests searched together')
+    serve_parser.add_argument('--max-memory', action='store', type=int, default=max_memory, help='megabytes of word vectors to hold per fan work (default {})'.format(max_memory))
+    serve_parser.set_defaults(func=serve)
+
+    pipeline_parser = subparsers.add_parser('pipeline', help='cleans and searches html files concurrently as they arrive')
+    pipeline_parser.add_argument('i', action='store', help='directory of input html files, e.g. the output of scrape')
+    pipeline_parser.add_argument('s', action='store', nargs='+', help='filenames for markup versions of one or more scripts')
+    pipeline_parser.add_argument('-o', action='store', default='plain-text', help='target directory for output txt files')
+    pipeline_parser.add_argument('-f', '--follow', action='store_true', help='keep watching the input directory for new files')
+    pipeline_parser.add_argument('--poll', action='store', type=float, default=10, help='seconds between checks for new files with --follow')
+    pipeline_parser.add_argument('--idle', action='store', type=float, default=600, help='seconds without new files after which --follow stops')
+    pipeline_parser.add_argument('--clean-workers', action='store', type=int, default=2, help='number of html cleaning processes')
+    pipeline_parser.add_argument('--search-workers', action='store', type=int, default=max(1, multiprocessing.cpu_count() - 2), help='number of search processes')
+    pipeline_parser.add_argument('--queue-size', action='store', type=int, default=16, help='maximum number of works waiting between stages')
+    pipeline_parser.add_argument('--work-timeout', action='store', type=float, default=3600, help='seconds after which a work that has not been cleaned or searched is logged as failed')
+    pipeline_parser.add_argument('--max-memory', action='store', type=int, default=max_memory, help='megabytes of word vectors to hold per fan work in each process (default {})'.format(max_memory))
+    pipeline_parser.set_defaults(func=pipeline)
+
+    merge_parser = subparsers.add_parser('merge', help='combines and verifies the output of sharded searches')
+    merge_parser.add_argument('i', action='store', nargs='+', help='shard manifest json files written by search --shard')
+    merge_parser.add_argument('-d', action='store', default=None, help='directory of fanwork text files to check for missing works')
+    merge_parser.set_defaults(func=merge_shards)
     
     matrix_parser = subparsers.add_parser('matrix', help='deduplicates and builds matrix for best n-gram matches')
     matrix_parser.add_argument('i', action='store', help='input csv file')
     matrix_parser.add_argument('m', action = 'store', help='fandom/movie name for output file prefix')
-    matrix_parser.add_argument('-n', action='store', default = 6, help='n-gram size, default is 6-grams')
+    matrix_parser.add_argument('-n', action='store', type=int, default = 6, help='n-gram size, default is 6-grams')
+    matrix_parser.add_argument('-s', action='store', default=None, help='script id (script filename without extension) to use when the input has matches for several scripts')
+    matrix_parser.add_argument('--state', action='store', default=None, help='file in which deduplication state is kept between runs; if it exists, the input csv is added to it as a new batch')
+    matrix_parser.add_argument('--where', action='store', default=None, help='metadata filter, e.g. \'language=English and published>=2016-01-01\'; requires --meta-db')
+    matrix_parser.add_argument('--meta-db', action='store', default=None, help='metadata store built by getmeta --db')
     matrix_parser.set_defaults(func=process)
     
     data_parser = subparsers.add_parser('format', help='takes a script and outputs a csv with senitment information for each word formatted for javascript visualization')
     data_parser.add_argument('s', action='store', help='filename for markup version of script')
     data_parser.add_argument('-o', action='store', default='js-data', help='filename for csv output file of data formatted for visualization')
+    data_parser.add_argument('-m', action='store', default=None, help='search results csv whose match counts are added to the aggregated tiles')
     data_parser.set_defaults(func=format_data)
+
+    store_parser = subparsers.add_parser('store', help='loads search results into an indexed sqlite match store')
+    store_parser.add_argument('i', action='store', help='input csv file of search results')
+    store_parser.add_argument('-o', action='store', default='matches.db', help='filename for the sqlite match store')
+    store_parser.set_defaults(func=make_store)
+
+    query_parser = subparsers.add_parser('query', help='queries a match store and writes csv to standard output')
+    query_parser.add_argument('db', action='store', help='filename of the sqlite match store')
+    query_parser.add_argument('-w', '--words', action='store', nargs=2, type=int, metavar=('START', 'END'), help='script word index range, inclusive')
+    query_parser.add_argument('-f', '--work', action='store', help='fanwork filename')
+    query_parser.add_argument('--scene', action='store', type=int, help='script scene number')
+    query_parser.add_argument('--character', action='store', help='script character name')
+    query_parser.add_argument('--script-id', action='store', help='script id (script filename without extension)')
+    query_parser.add_argument('-t', '--threshold', action='store', type=float, help='only matches below this combined distance')
+    query_parser.add_argument('-l', '--limit', action='store', type=int, help='maximum number of rows')
+    query_group = query_parser.add_mutually_exclusive_group()
+    query_group.add_argument('--works', action='store_true', help='list matching fanworks with their match counts')
+    query_group.add_argument('--top', action='store', type=int, help='list the TOP most frequently matched script words')
+    query_parser.set_defaults(func=query_store)
     
     #handle args
     args = parser.parse_args()
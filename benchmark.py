@@ -0,0 +1,272 @@
+# coding: utf-8
+
+import os
+import json
+import random
+import shutil
+import argparse
+import datetime
+import platform
+import subprocess
+from time import perf_counter
+
+import ao3
+
+# -----------------------------------------------------------------------------
+# Synthetic Corpus Settings
+# ---------------
+
+common_words = '''
+the be to of and a in that have it for not on with he as you do at this
+but his by from they we say her she or an will my one all would there
+their what so up out if about who get which go me when make can like
+time no just him know take people into year your good some could them
+see other than then now look only come its over think also back after
+use two how our work first well way even new want because any these give
+day most us ship ship's rebel base plan empire hope light dark force
+star war pilot fleet planet station run fight stay safe home long ago
+far away galaxy mission trust never always father mother friend brother
+sister together alone enough sorry please thank tell leave find lost
+'''.split()
+
+character_names = ['JYN', 'CASSIAN', 'K2SO', 'BODHI', 'CHIRRUT', 'BAZE',
+                   'SAW', 'KRENNIC', 'GALEN', 'MON MOTHMA']
+
+html_template = '''<html><head><title>{title}</title></head><body>
+<div class="preface group">
+<h2 class="title heading">{title}</h2>
+<h3 class="byline heading">{author}</h3>
+<div class="summary module"><h3 class="heading">Summary:</h3><blockquote class="userstuff"><p>{summary}</p></blockquote></div>
+<div class="notes module"><h3 class="heading">Notes:</h3><blockquote class="userstuff"><p>{notes}</p></blockquote></div>
+</div>
+<dl class="work meta group">
+<dt class="rating tags">Rating:</dt><dd class="rating tags"><a class="tag">{rating}</a></dd>
+<dt class="fandom tags">Fandom:</dt><dd class="fandom tags"><a class="tag">Synthetic Fandom</a></dd>
+<dt class="relationship tags">Relationship:</dt><dd class="relationship tags"><a class="tag">{relationship}</a></dd>
+<dt class="freeform tags">Additional Tags:</dt><dd class="freeform tags">{freeform}</dd>
+<dt class="language">Language:</dt><dd class="language">{language}</dd>
+<dt class="published">Published:</dt><dd class="published">{date}</dd>
+</dl>
+<div id="workskin"><div class="userstuff module"><h3 class="landmark heading">Work Text:</h3>
+{paragraphs}
+</div></div>
+</body></html>
+'''
+
+# ----------------------------
+# SYNTHETIC CORPUS FUNCTIONS
+# ----------------------------
+
+def random_sentence(rng, min_words=4, max_words=14):
+    # Mostly common words, with the occasional invented one so
+    # that fan works also contain words spacy has no vector for.
+    words = []
+    for i in range(rng.randint(min_words, max_words)):
+        if rng.random() < 0.03:
+            words.append(''.join(rng.choice('bcdfghklmnprstvz') + rng.choice('aeiou')
+                                 for j in range(3)))
+        else:
+            words.append(rng.choice(common_words))
+    return ' '.join(words).capitalize() + '.'
+
+def generate_script(filename, n_lines, rng, lines_per_scene=20):
+    # Write a markup script and return its lines of dialogue.
+    lines = []
+    with open(filename, 'w', encoding='utf-8') as out:
+        for i in range(n_lines):
+            if i % lines_per_scene == 0:
+                out.write('SCENE_NUMBER<<{}>>\n'.format(i // lines_per_scene + 1))
+            out.write('CHARACTER_NAME<<{}>>\n'.format(rng.choice(character_names)))
+            line = random_sentence(rng, 6, 16)
+            out.write('LINE<<{}>>\n'.format(line))
+            lines.append(line)
+    return lines
+
+def generate_fan_text(script_lines, n_words, quote_rate, rng):
+    # Each sentence is a script line with probability `quote_rate`,
+    # and otherwise random prose.
+    sentences = []
+    length = 0
+    while length < n_words:
+        if rng.random() < quote_rate:
+            sentence = '"{}"'.format(rng.choice(script_lines))
+        else:
+            sentence = random_sentence(rng)
+        sentences.append(sentence)
+        length += sentence.count(' ') + 1
+    return sentences
+
+def generate_fan_html(html_dir, script_lines, n_works, work_length,
+                      quote_rate, rng):
+    # Write `n_works` fake Archive of Our Own work pages. Work lengths
+    # are drawn from a log-normal distribution with a median of
+    # `work_length` words, so a few works are much longer than most.
+    os.makedirs(html_dir, exist_ok=True)
+    total_words = 0
+    for work_id in range(n_works):
+        n_words = max(20, int(rng.lognormvariate(0, 1) * work_length))
+        sentences = generate_fan_text(script_lines, n_words, quote_rate, rng)
+        paragraphs = ['<p>{}</p>'.format(' '.join(sentences[i:i + 5]))
+                      for i in range(0, len(sentences), 5)]
+        date = datetime.date(2010, 1, 1) + datetime.timedelta(days=rng.randrange(3000))
+        page = html_template.format(
+            title='Work {}'.format(work_id),
+            author='author{}'.format(rng.randrange(n_works // 3 + 1)),
+            summary=random_sentence(rng),
+            notes=random_sentence(rng),
+            rating=rng.choice(['General Audiences', 'Teen And Up Audiences', 'Mature']),
+            relationship='/'.join(rng.sample(character_names, 2)).title(),
+            freeform=' '.join('<a class="tag">{}</a>'.format(rng.choice(common_words))
+                              for i in range(3)),
+            language=rng.choice(['English'] * 9 + ['Deutsch']),
+            date=date.isoformat(),
+            paragraphs='\n'.join(paragraphs)
+        )
+        with open(os.path.join(html_dir, '{}.html'.format(work_id)), 'w',
+                  encoding='utf-8') as out:
+            out.write(page)
+        total_words += n_words
+    return total_words
+
+def generate(inputs):
+    rng = random.Random(inputs['seed'])
+    out_dir = inputs['o']
+    os.makedirs(out_dir, exist_ok=True)
+    script_lines = generate_script(os.path.join(out_dir, 'script-markup.txt'),
+                                   inputs['script_lines'], rng)
+    generate_fan_html(os.path.join(out_dir, 'html'), script_lines, inputs['works'],
+                      inputs['work_length'], inputs['quote_rate'], rng)
+
+# -------------------
+# BENCHMARK FUNCTIONS
+# -------------------
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def timed(results, stage, n_works, n_words, func, *args):
+    start = perf_counter()
+    value = func(*args)
+    seconds = perf_counter() - start
+    results.append({'stage': stage, 'works': n_works,
+                    'words': n_words, 'seconds': seconds})
+    print('{:>8} works  {:<8} {:10.3f}s'.format(n_works, stage, seconds))
+    return value
+
+def benchmark_size(n_works, inputs, results):
+    # Generate a corpus of `n_works` works in its own directory and
+    # run every stage of the pipeline over it. The stages write their
+    # outputs to the current directory, so we work from inside it.
+    rng = random.Random(inputs['seed'])
+    size_dir = os.path.abspath(os.path.join(inputs['work_dir'], str(n_works)))
+    os.makedirs(size_dir, exist_ok=True)
+
+    script = os.path.join(size_dir, 'script-markup.txt')
+    script_lines = generate_script(script, inputs['script_lines'], rng)
+    html_dir = os.path.join(size_dir, 'html')
+    text_dir = os.path.join(size_dir, 'text')
+    n_words = generate_fan_html(html_dir, script_lines, n_works,
+                                inputs['work_length'], inputs['quote_rate'], rng)
+
+    cwd = os.getcwd()
+    os.chdir(size_dir)
+    try:
+        timed(results, 'clean', n_works, n_words,
+              ao3.convert_dir, {'i': html_dir, 'o': text_dir})
+        timed(results, 'getmeta', n_works, n_words,
+              ao3.collect_meta, {'i': html_dir, 'o': 'fan-meta'})
+        match_file = timed(results, 'search', n_works, n_words,
+                           ao3.analyze, {'d': text_dir, 's': [script], 'shard': None,
+                                         'max_memory': ao3.max_memory})
+        timed(results, 'matrix', n_works, n_words,
+              ao3.process, {'n': 6, 'i': match_file, 'm': 'synthetic', 's': None})
+        timed(results, 'format', n_works, n_words,
+              ao3.format_data, {'s': script, 'o': 'js-data'})
+    finally:
+        os.chdir(cwd)
+
+def load_last_run(filename):
+    with open(filename, encoding='utf-8') as ip:
+        runs = [json.loads(line) for line in ip if line.strip()]
+    return runs[-1] if runs else None
+
+def compare_runs(previous, run):
+    # Print the time of each stage relative to the previous run;
+    # ratios above 1 are slowdowns.
+    before = {(r['stage'], r['works']): r['seconds'] for r in previous['results']}
+    print('\nCompared with run of {} ({}):'.format(previous['date'], previous['commit']))
+    for r in run['results']:
+        key = (r['stage'], r['works'])
+        if key in before and before[key] > 0:
+            print('{:>8} works  {:<8} {:6.2f}x'.format(r['works'], r['stage'],
+                                                   r['seconds'] / before[key]))
+
+def run_benchmarks(inputs):
+    results_file = inputs['o']
+    previous = None
+    if os.path.exists(results_file):
+        previous = load_last_run(results_file)
+
+    run = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+           'commit': git_commit(),
+           'python': platform.python_version(),
+           'platform': platform.platform(),
+           'settings': {k: inputs[k] for k in ['seed', 'script_lines', 'work_length',
+                                               'quote_rate', 'sizes']},
+           'results': []}
+
+    for n_works in inputs['sizes']:
+        benchmark_size(n_works, inputs, run['results'])
+
+    if not inputs['keep']:
+        shutil.rmtree(inputs['work_dir'], ignore_errors=True)
+
+    with open(results_file, 'a', encoding='utf-8') as out:
+        out.write(json.dumps(run))
+        out.write('\n')
+
+    if previous and previous['settings'] == run['settings']:
+        compare_runs(previous, run)
+
+# -----------------------------------------------------------------------------
+# SCRIPT
+# ------
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='generate synthetic fanworks and benchmark ao3.py.')
+    subparsers = parser.add_subparsers(help='generate or run')
+
+    def add_corpus_arguments(p):
+        p.add_argument('--seed', action='store', type=int, default=4815162342, help='random seed for the synthetic corpus')
+        p.add_argument('--script-lines', action='store', type=int, default=1000, help='number of lines of dialogue in the script')
+        p.add_argument('--work-length', action='store', type=int, default=2000, help='median fanwork length in words')
+        p.add_argument('--quote-rate', action='store', type=float, default=0.02, help='fraction of fanwork sentences quoted from the script')
+
+    generate_parser = subparsers.add_parser('generate', help='writes a synthetic script and directory of fanwork html files')
+    generate_parser.add_argument('works', action='store', type=int, help='number of fanworks')
+    generate_parser.add_argument('-o', action='store', default='synthetic-corpus', help='target directory')
+    add_corpus_arguments(generate_parser)
+    generate_parser.set_defaults(func=generate)
+
+    run_parser = subparsers.add_parser('run', help='times clean, getmeta, search, matrix and format over synthetic corpora')
+    run_parser.add_argument('-s', '--sizes', action='store', nargs='+', type=int, default=[10, 100, 1000], help='numbers of fanworks to benchmark')
+    run_parser.add_argument('-o', action='store', default='benchmark-results.jsonl', help='file to which results are appended, one json run per line')
+    run_parser.add_argument('-w', '--work-dir', action='store', default='benchmark-work', help='directory for the synthetic corpora and stage outputs')
+    run_parser.add_argument('-k', '--keep', action='store_true', help='keep the work directory afterwards')
+    add_corpus_arguments(run_parser)
+    run_parser.set_defaults(func=run_benchmarks)
+
+    #handle args
+    args = parser.parse_args()
+
+    #call function
+    if args.func:
+        args.func(vars(args))